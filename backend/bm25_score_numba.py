@@ -0,0 +1,38 @@
+"""
+Numba JIT kernel for BM25 scoring.
+Optional backend for BM25.search, enabled with BM25.activate_numba().
+
+Postings are passed as three flat arrays (CSR layout):
+    offsets[t]:offsets[t + 1]  ->  slice of doc_ids / tfs for term id t
+"""
+
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True, fastmath=True, parallel=True)
+def score_query(query_term_ids, query_idfs, postings_offsets, postings_doc_ids,
+                postings_tfs, len_norm, k1, scores):
+    """
+    Accumulate BM25 scores for one query into `scores` (in place).
+
+    Each query term is scored into its own row of a local buffer so the
+    parallel loop needs no atomics; rows are reduced into `scores` at the end.
+    """
+    n_terms = query_term_ids.shape[0]
+    n_docs = scores.shape[0]
+    partial = np.zeros((n_terms, n_docs), dtype=np.float32)
+
+    for i in numba.prange(n_terms):
+        term_id = query_term_ids[i]
+        idf = query_idfs[i]
+        for p in range(postings_offsets[term_id], postings_offsets[term_id + 1]):
+            doc_id = postings_doc_ids[p]
+            tf = postings_tfs[p]
+            partial[i, doc_id] += idf * (tf * (k1 + 1)) / (tf + k1 * len_norm[doc_id])
+
+    for d in numba.prange(n_docs):
+        total = 0.0
+        for i in range(n_terms):
+            total += partial[i, d]
+        scores[d] += total
@@ -9,16 +9,35 @@ Architecture:
 """
 
 import asyncio
+import hashlib
 import json
-import math
 import os
 import pickle
+import random
 import re
-from collections import Counter
+import sqlite3
+import threading
+from collections import Counter, OrderedDict, namedtuple
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 import numpy as np
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
+
+try:
+    import hnswlib
+except ImportError:  # Optional: vector search falls back to brute-force cosine
+    hnswlib = None
+
+try:
+    import simsimd
+except ImportError:  # Optional: brute-force scan falls back to NumPy BLAS
+    simsimd = None
+
+try:
+    import orjson
+except ImportError:  # Optional: reranker tool arguments parsed with stdlib json
+    orjson = None
 
 
 # ============================================================================
@@ -29,18 +48,51 @@ class BM25:
     """
     BM25 (Okapi BM25) ranking function for keyword-based retrieval.
     Better than TF-IDF for document ranking.
+
+    The index is stored as Structure-of-Arrays posting lists so a query is
+    scored with a handful of vectorized NumPy operations per query term
+    instead of a Python loop over every document. Tokens are interned to
+    integer term ids in fit(); every per-term statistic is an array indexed
+    by term id, and `vocab` is the only string-keyed structure.
     """
     
+    # MaxScore pruning is attempted only when the postings left to score are
+    # at least this many times the number of documents already touched
+    PRUNE_MIN_RATIO = 4
+    
+    # search_batch scores at most this many queries per dense (Q, N) block
+    BATCH_MAX_QUERIES = 256
+    
+    _TOKEN_RE = re.compile(r'\b[a-z0-9]+\b')
+    
+    # Persisted index: one .npy per array (memory-mapped on load) + JSON
+    INDEX_DIR = "kbli_bm25_index"
+    INDEX_FORMAT_VERSION = 1
+    _INDEX_ARRAYS = (
+        "postings_offsets", "postings_doc_ids", "postings_tfs",
+        "doc_freqs", "idf", "max_score", "doc_len", "len_norm", "doc_token_ids"
+    )
+    
     def __init__(self, k1: float = 1.5, b: float = 0.75):
         self.k1 = k1  # Term frequency saturation parameter
         self.b = b    # Length normalization parameter
         self.corpus_size = 0
         self.avgdl = 0  # Average document length
-        self.doc_freqs = {}  # Document frequency for each term
-        self.idf = {}  # Inverse document frequency
-        self.doc_len = []  # Length of each document
-        self.documents = []  # Tokenized documents
+        self.doc_freqs = np.zeros(0, dtype=np.int32)  # term id -> document frequency
+        self.idf = np.zeros(0, dtype=np.float32)  # term id -> inverse document frequency
+        self.doc_len = np.zeros(0, dtype=np.float32)  # Length of each document
+        self.len_norm = np.zeros(0, dtype=np.float32)  # 1 - b + b * dl / avgdl
+        self.postings = []  # term id -> (doc_ids: int32, tfs: float32)
+        self.max_score = np.zeros(0, dtype=np.float32)  # term id -> best BM25 contribution
+        self.vocab = {}  # term -> term id (row in the flat posting arrays)
+        # Flat CSR postings: term id t owns [offsets[t], offsets[t + 1])
+        self.postings_offsets = np.zeros(1, dtype=np.int64)
+        self.postings_doc_ids = np.zeros(0, dtype=np.int32)
+        self.postings_tfs = np.zeros(0, dtype=np.float32)
+        self.documents = []  # Tokenized documents, as int32 term id arrays
         self.original_docs = []  # Original document dicts
+        self._numba_score = None  # JIT kernel, set by activate_numba()
+        self._reset_query_cache()
     
     def _tokenize(self, text: str) -> list[str]:
         """Tokenize text into words, Indonesian-aware"""
@@ -49,10 +101,26 @@ class BM25:
         # Lowercase and split, keep only alphanumeric
         text = text.lower()
         # Remove punctuation but keep Indonesian characters
-        tokens = re.findall(r'\b[a-z0-9]+\b', text)
+        tokens = self._TOKEN_RE.findall(text)
         # Filter very short tokens
         return [t for t in tokens if len(t) > 1]
     
+    def _reset_query_cache(self):
+        """(Re)create the per-index cache of tokenized queries"""
+        self._query_terms = lru_cache(maxsize=1024)(self._build_query_terms)
+    
+    def _build_query_terms(self, query: str) -> tuple[tuple[int, float], ...]:
+        """
+        Tokenize a query into (term id, weight) pairs for indexed terms only.
+        Repeated query tokens fold into one pass: weight = idf * count.
+        """
+        vocab = self.vocab
+        term_ids = Counter(vocab[t] for t in self._tokenize(query) if t in vocab)
+        return tuple(
+            (term_id, float(self.idf[term_id]) * count)
+            for term_id, count in term_ids.items()
+        )
+    
     def fit(self, documents: list[dict], text_fields: list[str] = None):
         """
         Build BM25 index from documents.
@@ -64,33 +132,201 @@ class BM25:
         if text_fields is None:
             text_fields = ["judul", "hierarki", "cakupan"]
         
+        texts = [" ".join(str(doc.get(f, "")) for f in text_fields) for doc in documents]
+        self.fit_from_texts(texts, documents)
+    
+    def fit_from_texts(self, texts: list[str], documents: list[dict]):
+        """
+        Build BM25 index from pre-joined document texts.
+        
+        Args:
+            texts: One combined text per document (same order as documents)
+            documents: List of document dicts (kept as original_docs)
+        """
+        self._reset_query_cache()
         self.original_docs = documents
         self.corpus_size = len(documents)
         self.documents = []
-        self.doc_len = []
+        doc_len = []
         
-        # Tokenize all documents
-        for doc in documents:
-            combined_text = " ".join(str(doc.get(f, "")) for f in text_fields)
-            tokens = self._tokenize(combined_text)
-            self.documents.append(tokens)
-            self.doc_len.append(len(tokens))
+        # Tokenize all documents, interning tokens to term ids in order of
+        # first appearance, and collect (doc_idx, tf) postings per term id
+        self.vocab = {}
+        posting_ids: list[list[int]] = []
+        posting_tfs: list[list[int]] = []
+        for doc_idx, combined_text in enumerate(texts):
+            token_ids = []
+            for token in self._tokenize(combined_text):
+                term_id = self.vocab.get(token)
+                if term_id is None:
+                    term_id = self.vocab[token] = len(posting_ids)
+                    posting_ids.append([])
+                    posting_tfs.append([])
+                token_ids.append(term_id)
+            self.documents.append(np.asarray(token_ids, dtype=np.int32))
+            doc_len.append(len(token_ids))
+            for term_id, tf in Counter(token_ids).items():
+                posting_ids[term_id].append(doc_idx)
+                posting_tfs[term_id].append(tf)
+        
+        self.doc_len = np.asarray(doc_len, dtype=np.float32)
         
         # Calculate average document length
-        self.avgdl = sum(self.doc_len) / self.corpus_size if self.corpus_size > 0 else 0
+        self.avgdl = float(self.doc_len.mean()) if self.corpus_size > 0 else 0
+        
+        # Length normalization is query-independent, so fold it once here
+        if self.avgdl > 0:
+            self.len_norm = (1 - self.b + self.b * self.doc_len / self.avgdl).astype(np.float32)
+        else:
+            self.len_norm = np.ones(self.corpus_size, dtype=np.float32)
         
-        # Calculate document frequencies
-        self.doc_freqs = {}
-        for tokens in self.documents:
-            unique_tokens = set(tokens)
-            for token in unique_tokens:
-                self.doc_freqs[token] = self.doc_freqs.get(token, 0) + 1
+        # Flatten postings into CSR arrays; per-term views share the buffers
+        self.doc_freqs = np.fromiter(
+            (len(ids) for ids in posting_ids), dtype=np.int32, count=len(posting_ids)
+        )
+        self.postings_offsets = np.zeros(len(self.doc_freqs) + 1, dtype=np.int64)
+        np.cumsum(self.doc_freqs, out=self.postings_offsets[1:])
+        self.postings_doc_ids = np.fromiter(
+            (i for ids in posting_ids for i in ids),
+            dtype=np.int32, count=int(self.postings_offsets[-1])
+        )
+        self.postings_tfs = np.fromiter(
+            (tf for tfs in posting_tfs for tf in tfs),
+            dtype=np.float32, count=int(self.postings_offsets[-1])
+        )
+        self._build_views()
+        
+        # IDF with smoothing to avoid negative values
+        df = self.doc_freqs.astype(np.float64)
+        self.idf = np.log((self.corpus_size - df + 0.5) / (df + 0.5) + 1).astype(np.float32)
         
-        # Calculate IDF for each term
-        self.idf = {}
-        for term, df in self.doc_freqs.items():
-            # IDF with smoothing to avoid negative values
-            self.idf[term] = math.log((self.corpus_size - df + 0.5) / (df + 0.5) + 1)
+        # Per-term score upper bounds for MaxScore pruning in search()
+        self.max_score = np.zeros(len(self.vocab), dtype=np.float32)
+        if self.vocab:
+            idf_per_posting = np.repeat(self.idf, self.doc_freqs)
+            tfs = self.postings_tfs
+            contrib = idf_per_posting * (tfs * (self.k1 + 1)) / (
+                tfs + self.k1 * self.len_norm[self.postings_doc_ids]
+            )
+            self.max_score = np.maximum.reduceat(contrib, self.postings_offsets[:-1])
+    
+    def _build_views(self):
+        """Per-term posting views over the flat CSR arrays (no copies)"""
+        self.postings = [
+            (self.postings_doc_ids[start:end], self.postings_tfs[start:end])
+            for start, end in zip(self.postings_offsets[:-1], self.postings_offsets[1:])
+        ]
+    
+    @staticmethod
+    def corpus_hash(texts: list[str]) -> str:
+        """SHA-256 over the indexed texts, used to detect a stale saved index"""
+        h = hashlib.sha256()
+        for text in texts:
+            h.update(text.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+    
+    def save(self, index_dir: Path, corpus_hash: str):
+        """
+        Persist the fitted index as .npy arrays + vocab/meta JSON.
+        meta.json is written last (atomically), so a partially written
+        directory never passes the hash check in load().
+        """
+        try:
+            index_dir.mkdir(parents=True, exist_ok=True)
+            meta_path = index_dir / "meta.json"
+            meta_path.unlink(missing_ok=True)
+            
+            arrays = {name: getattr(self, name) for name in self._INDEX_ARRAYS if name != "doc_token_ids"}
+            arrays["doc_token_ids"] = (
+                np.concatenate(self.documents) if self.documents else np.zeros(0, dtype=np.int32)
+            )
+            for name, array in arrays.items():
+                # Temp file + swap, so live mmaps of the old file stay valid
+                tmp_path = index_dir / f"{name}.npy.tmp"
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, np.ascontiguousarray(array))
+                os.replace(tmp_path, index_dir / f"{name}.npy")
+            with open(index_dir / "vocab.json", 'w', encoding='utf-8') as f:
+                json.dump(list(self.vocab), f, ensure_ascii=False)
+            
+            meta = {
+                "version": self.INDEX_FORMAT_VERSION,
+                "corpus_sha256": corpus_hash,
+                "corpus_size": self.corpus_size,
+                "avgdl": self.avgdl,
+                "k1": self.k1,
+                "b": self.b,
+            }
+            tmp_path = index_dir / "meta.json.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+            print(f"✅ Saved BM25 index to {index_dir}")
+        except Exception as e:
+            print(f"⚠️ BM25 index save failed: {e}")
+    
+    def load(self, index_dir: Path, corpus_hash: str, documents: list[dict]) -> bool:
+        """
+        Load an index written by save(), memory-mapping the arrays.
+        Returns False if it is missing, stale (corpus hash or k1/b differ)
+        or unreadable, in which case the caller should fit() instead.
+        """
+        meta_path = index_dir / "meta.json"
+        if not meta_path.exists():
+            return False
+        
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if (meta.get("version") != self.INDEX_FORMAT_VERSION
+                    or meta.get("corpus_sha256") != corpus_hash
+                    or meta.get("corpus_size") != len(documents)
+                    or meta.get("k1") != self.k1 or meta.get("b") != self.b):
+                print("⚠️ BM25 index cache is stale, rebuilding...")
+                return False
+            
+            arrays = {
+                name: np.load(index_dir / f"{name}.npy", mmap_mode='r')
+                for name in self._INDEX_ARRAYS
+            }
+            with open(index_dir / "vocab.json", 'r', encoding='utf-8') as f:
+                vocab = {term: term_id for term_id, term in enumerate(json.load(f))}
+        except Exception as e:
+            print(f"⚠️ BM25 index load failed: {e}")
+            return False
+        
+        self._reset_query_cache()
+        self.original_docs = documents
+        self.corpus_size = meta["corpus_size"]
+        self.avgdl = meta["avgdl"]
+        self.vocab = vocab
+        doc_token_ids = arrays.pop("doc_token_ids")
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        doc_offsets = np.cumsum(self.doc_len.astype(np.int64))[:-1]
+        self.documents = np.split(doc_token_ids, doc_offsets) if self.corpus_size else []
+        self._build_views()
+        return True
+    
+    def activate_numba(self) -> bool:
+        """
+        Switch search() to the Numba JIT scoring kernel.
+        Returns False (and keeps the NumPy scorer) if numba is not installed.
+        """
+        try:
+            try:
+                from backend.bm25_score_numba import score_query
+            except ImportError:
+                from bm25_score_numba import score_query
+        except ImportError as e:
+            print(f"⚠️ Numba scorer unavailable, using NumPy BM25: {e}")
+            return False
+        
+        self._numba_score = score_query
+        # Trigger JIT compilation now instead of on the first user query
+        self._score_query_numba(())
+        return True
     
     def search(self, query: str, top_k: int = 10) -> list[tuple[int, float]]:
         """
@@ -99,40 +335,327 @@ class BM25:
         Returns:
             List of (doc_index, score) tuples, sorted by score descending
         """
-        query_tokens = self._tokenize(query)
-        if not query_tokens:
+        query_terms = self._query_terms(query)
+        if not query_terms or self.corpus_size == 0:
             return []
         
-        scores = []
-        for idx, doc_tokens in enumerate(self.documents):
-            score = self._score_document(query_tokens, doc_tokens, self.doc_len[idx])
-            if score > 0:
-                scores.append((idx, score))
+        if self._numba_score is not None:
+            scores = self._score_query_numba(query_terms)
+        else:
+            scores = self._score_query(query_terms, top_k)
+        return self._top_k(scores, top_k)
+    
+    def search_batch(self, queries: list[str], top_k: int = 10) -> list[list[tuple[int, float]]]:
+        """
+        Search many queries in one pass over the inverted index.
+        
+        Each distinct term's posting list is read and its BM25 term-frequency
+        part computed once, then broadcast into the (queries x docs) score
+        block for every query containing that term.
         
-        # Sort by score descending
-        scores.sort(key=lambda x: x[1], reverse=True)
-        return scores[:top_k]
+        Returns:
+            One search() result list per query, in input order
+        """
+        results = []
+        for start in range(0, len(queries), self.BATCH_MAX_QUERIES):
+            chunk = queries[start:start + self.BATCH_MAX_QUERIES]
+            results.extend(self._search_batch_chunk(chunk, top_k))
+        return results
     
-    def _score_document(self, query_tokens: list[str], doc_tokens: list[str], doc_len: int) -> float:
-        """Calculate BM25 score for a single document"""
-        score = 0.0
-        doc_term_freqs = Counter(doc_tokens)
+    def _search_batch_chunk(self, queries: list[str], top_k: int) -> list[list[tuple[int, float]]]:
+        """search_batch for one block of queries"""
+        if self.corpus_size == 0:
+            return [[] for _ in queries]
         
-        for term in query_tokens:
-            if term not in self.idf:
-                continue
+        # term id -> (query rows containing it, per-query weights)
+        rows_by_term: dict[int, tuple[list[int], list[float]]] = {}
+        for row, query in enumerate(queries):
+            for term, weight in self._query_terms(query):
+                rows, weights = rows_by_term.setdefault(term, ([], []))
+                rows.append(row)
+                weights.append(weight)
+        
+        # Dense (queries x terms) weights times (terms x docs) BM25 term scores:
+        # each posting list is scored once and the accumulation is one GEMM.
+        weights = np.zeros((len(queries), len(rows_by_term)), dtype=np.float32)
+        term_scores = np.zeros((len(rows_by_term), self.corpus_size), dtype=np.float32)
+        for col, (term, (rows, term_weights)) in enumerate(rows_by_term.items()):
+            doc_ids, tfs = self.postings[term]
+            term_scores[col, doc_ids] = (tfs * (self.k1 + 1)) / (tfs + self.k1 * self.len_norm[doc_ids])
+            weights[rows, col] = term_weights
+        scores = weights @ term_scores
+        
+        return [self._top_k(row_scores, top_k) for row_scores in scores]
+    
+    def _score_query(self, query_terms: tuple[tuple[int, float], ...], top_k: int) -> np.ndarray:
+        """
+        Accumulate BM25 scores into a dense array, with MaxScore pruning.
+        
+        Terms are processed by decreasing max_score. Once the summed upper
+        bound of the remaining terms drops below the current k-th best score,
+        no unseen document can reach the top-k, so the remaining terms are
+        only probed for the surviving candidates instead of scanning their
+        full posting lists. Scores outside the top-k may be left partial.
+        """
+        # (term, weight, score upper bound), best bound first
+        terms = sorted(
+            ((t, w, float(self.max_score[t]) * w / float(self.idf[t])) for t, w in query_terms),
+            key=lambda x: x[2],
+            reverse=True
+        )
+        scores = np.zeros(self.corpus_size, dtype=np.float32)
+        remaining_max_sum = sum(bound for _, _, bound in terms)
+        scored_max_sum = 0.0  # Upper bound of any score accumulated so far
+        remaining_postings = sum(int(self.doc_freqs[t]) for t, _, _ in terms)
+        scored_postings = 0  # Upper bound of documents touched so far
+        threshold = 0.0
+        candidates = None  # Set once pruning kicks in
+        
+        for i, (term, weight, bound) in enumerate(terms):
+            doc_ids, tfs = self.postings[term]
             
-            tf = doc_term_freqs.get(term, 0)
-            if tf == 0:
-                continue
+            if candidates is not None:
+                # Drop candidates that can no longer beat the threshold, then
+                # look the rest up in the (doc-ordered) posting list
+                candidates = candidates[scores[candidates] + remaining_max_sum >= threshold]
+                pos = np.minimum(np.searchsorted(doc_ids, candidates), len(doc_ids) - 1)
+                hit = doc_ids[pos] == candidates
+                doc_ids, tfs = candidates[hit], tfs[pos[hit]]
             
-            idf = self.idf[term]
-            # BM25 formula
-            numerator = tf * (self.k1 + 1)
-            denominator = tf + self.k1 * (1 - self.b + self.b * (doc_len / self.avgdl))
-            score += idf * (numerator / denominator)
+            # BM25 formula, length normalization precomputed in fit()
+            numerator = tfs * (self.k1 + 1)
+            denominator = tfs + self.k1 * self.len_norm[doc_ids]
+            # doc_ids are unique within a posting list, so plain fancy-index
+            # accumulation is safe (no need for the slower np.add.at)
+            scores[doc_ids] += weight * (numerator / denominator)
+            
+            remaining_max_sum -= bound
+            scored_max_sum += bound
+            remaining_postings -= int(self.doc_freqs[term])
+            scored_postings += len(doc_ids)
+            # Pruning costs a selection over the touched documents, so only
+            # try it when the threshold could exceed the remaining bound
+            # (it never exceeds scored_max_sum) and the postings left to skip
+            # clearly outweigh that cost
+            if (top_k <= 0 or i + 1 == len(terms)
+                    or remaining_max_sum >= scored_max_sum
+                    or remaining_postings < self.PRUNE_MIN_RATIO * scored_postings):
+                continue
+            pool = np.flatnonzero(scores) if candidates is None else candidates
+            if len(pool) > top_k:
+                kth = len(pool) - top_k
+                threshold = float(np.partition(scores[pool], kth)[kth])
+                if remaining_max_sum < threshold:
+                    candidates = pool
+        
+        return scores
+    
+    def _score_query_numba(self, query_terms: tuple[tuple[int, float], ...]) -> np.ndarray:
+        """Same as _score_query, but runs the posting loop in the JIT kernel"""
+        query_term_ids = np.array([t for t, _ in query_terms], dtype=np.int64)
+        query_idfs = np.array([w for _, w in query_terms], dtype=np.float32)
+        
+        scores = np.zeros(self.corpus_size, dtype=np.float32)
+        self._numba_score(
+            query_term_ids, query_idfs,
+            self.postings_offsets, self.postings_doc_ids, self.postings_tfs,
+            self.len_norm, np.float32(self.k1), scores
+        )
+        return scores
+    
+    @staticmethod
+    def _top_k(scores: np.ndarray, top_k: int) -> list[tuple[int, float]]:
+        """Select the top_k positive scores without fully sorting the array"""
+        if top_k <= 0:
+            return []
+        
+        if top_k < len(scores):
+            top_indices = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            top_indices = np.arange(len(scores))
+        
+        # Order only the selected slice
+        top_indices = top_indices[np.argsort(-scores[top_indices], kind="stable")]
+        return [(int(idx), float(scores[idx])) for idx in top_indices if scores[idx] > 0]
+
+
+# ============================================================================
+# Query Embedding Cache
+# ============================================================================
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of query embeddings.
+    
+    Keys are SHA-256 of (model, normalized text); values are the raw float32
+    bytes. An in-memory LRU sits in front of an optional sqlite table so
+    repeated queries (e.g. re-running the same Excel sheet) and warm
+    restarts skip the embeddings API entirely.
+    """
+    
+    def __init__(self, model: str, maxsize: int = 10_000, db_path: Path = None):
+        self.model = model
+        self.maxsize = maxsize
+        self._lru: OrderedDict[str, bytes] = OrderedDict()
+        self._db = None
+        if db_path is not None:
+            try:
+                self._db = sqlite3.connect(str(db_path), check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, embedding BLOB)"
+                )
+            except sqlite3.Error as e:
+                print(f"⚠️ Query embedding cache DB unavailable: {e}")
+                self._db = None
+    
+    def _key(self, text: str) -> str:
+        normalized = " ".join(text.lower().split())
+        return hashlib.sha256(f"{self.model}\0{normalized}".encode("utf-8")).hexdigest()
+    
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """Return the cached embedding for text, or None"""
+        key = self._key(text)
+        raw = self._lru.get(key)
+        if raw is not None:
+            self._lru.move_to_end(key)
+        elif self._db is not None:
+            row = self._db.execute(
+                "SELECT embedding FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            raw = row[0]
+            self._remember(key, raw)
+        else:
+            return None
+        return np.frombuffer(raw, dtype=np.float32)
+    
+    def put(self, text: str, embedding: np.ndarray):
+        """Store an embedding for text"""
+        key = self._key(text)
+        raw = np.asarray(embedding, dtype=np.float32).tobytes()
+        self._remember(key, raw)
+        if self._db is not None:
+            try:
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO query_embeddings (key, embedding) VALUES (?, ?)",
+                        (key, raw)
+                    )
+            except sqlite3.Error as e:
+                print(f"⚠️ Query embedding cache write failed: {e}")
+    
+    def _remember(self, key: str, raw: bytes):
+        self._lru[key] = raw
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+
+# ============================================================================
+# Micro-batching
+# ============================================================================
+
+class MicroBatcher:
+    """
+    Debounce/flush core shared by the request micro-batchers.
+    
+    Items submitted within WINDOW_SECONDS of the first pending one (or
+    until MAX_BATCH are pending) are handed to _flush() as one batch of
+    (item, future) pairs; _flush() must resolve every future.
+    """
+    
+    WINDOW_SECONDS = 0.01
+    MAX_BATCH = 16
+    
+    def __init__(self):
+        self._pending: list[tuple[object, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # The loop only keeps weak references to tasks: hold in-flight
+        # flushes here so none is garbage-collected with callers waiting
+        self._flush_tasks: set[asyncio.Task] = set()
+    
+    async def _submit(self, item):
+        """Queue item for the next batch and wait for its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        
+        if len(self._pending) >= self.MAX_BATCH:
+            self._schedule_flush(loop)
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.WINDOW_SECONDS, self._schedule_flush, loop)
+        return await future
+    
+    def _schedule_flush(self, loop: asyncio.AbstractEventLoop):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = loop.create_task(self._flush(batch))
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+    
+    async def aclose(self):
+        """Flush pending items and wait for in-flight batches (shutdown)"""
+        self._schedule_flush(asyncio.get_running_loop())
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+    
+    async def _flush(self, batch: list[tuple[object, asyncio.Future]]):
+        raise NotImplementedError
+
+
+# ============================================================================
+# Query Embedding Coalescer
+# ============================================================================
+
+class EmbeddingCoalescer(MicroBatcher):
+    """
+    Micro-batches concurrent single-text embedding requests.
+    
+    Callers await embed(text); requests arriving within WINDOW_SECONDS of
+    the first pending one (or until MAX_BATCH texts are pending) are sent
+    as a single embeddings.create(input=[...]) call, so N concurrent
+    queries (e.g. an Excel batch) cost one round-trip instead of N.
+    """
+    
+    WINDOW_SECONDS = 0.008
+    MAX_BATCH = 64
+    
+    def __init__(self, openai_client: AsyncOpenAI, model: str):
+        super().__init__()
+        self.client = openai_client
+        self.model = model
+    
+    async def embed(self, text: str) -> np.ndarray:
+        """Embedding for one text, batched with other concurrent callers"""
+        return await self._submit(text)
+    
+    async def _flush(self, batch: list[tuple[str, asyncio.Future]]):
+        # Identical texts in one window share a single input slot
+        unique_texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            response = await self.client.embeddings.create(
+                model=self.model,
+                input=unique_texts
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
         
-        return score
+        by_text = {
+            text: np.array(e.embedding, dtype=np.float32)
+            for text, e in zip(unique_texts, response.data)
+        }
+        for text, future in batch:
+            if not future.done():
+                future.set_result(by_text[text])
 
 
 # ============================================================================
@@ -143,71 +666,260 @@ class LocalVectorStore:
     """
     Local in-memory vector store using numpy for similarity search.
     Uses OpenAI text-embedding-3-small for embeddings.
+    
+    Queries go through an HNSW index (hnswlib) when the library is installed
+    and the corpus is large enough, otherwise through a brute-force scan
+    (int8 SimSIMD kernel if installed, float32 NumPy BLAS otherwise).
     """
     
     EMBEDDING_MODEL = "text-embedding-3-small"
     EMBEDDING_DIM = 1536
-    CACHE_FILE = "kbli_embeddings_cache.pkl"
+    CACHE_FILE = "kbli_embeddings.npy"  # float32 matrix, memory-mapped on load
+    DOCS_CACHE_FILE = "kbli_docs.json"
+    LEGACY_CACHE_FILE = "kbli_embeddings_cache.pkl"  # Pre-.npy pickle cache
+    INDEX_FILE = "kbli_hnsw_index.bin"
+    QUERY_CACHE_FILE = "kbli_query_embeddings.sqlite"
+    
+    # HNSW parameters. Approximate search only starts well above the KBLI
+    # corpus (~2.8k entries): at that size the exact int8/float32 scan is
+    # sub-millisecond and HNSW would only cost recall. Configurable with the
+    # HNSW_MIN_DOCS environment variable (hnswlib must be installed)
+    HNSW_MIN_DOCS = int(os.getenv("HNSW_MIN_DOCS", "50000"))
+    HNSW_M = 16
+    HNSW_EF_CONSTRUCTION = 200
+    HNSW_EF_SEARCH = 100
+    
+    # int8 brute-force scan: shortlist this many times top_k, then rescore
+    # the shortlist exactly in float32
+    INT8_OVERSAMPLE = 4
+    
+    # Index build: concurrent embedding batches and per-batch retries
+    EMBED_MAX_IN_FLIGHT = 5
+    EMBED_MAX_RETRIES = 5
     
     def __init__(self, openai_client: AsyncOpenAI):
         self.client = openai_client
         self.embeddings: np.ndarray = None  # Shape: (n_docs, embedding_dim)
+        self.embeddings_int8: np.ndarray = None  # Quantized copy for the brute-force scan
+        self.int8_inv_scale: np.ndarray = None  # Per-row dequantization factor
         self.documents: list[dict] = []
+        self.index = None  # hnswlib.Index, None when using brute force
+        # In-memory until build_index() is given a cache_dir to persist into
+        self.query_cache = EmbeddingCache(self.EMBEDDING_MODEL)
+        self.coalescer = EmbeddingCoalescer(openai_client, self.EMBEDDING_MODEL)
         self.is_ready = False
     
-    async def _get_embedding(self, text: str) -> np.ndarray:
-        """Get embedding for a single text"""
-        response = await self.client.embeddings.create(
-            model=self.EMBEDDING_MODEL,
-            input=text
-        )
-        return np.array(response.data[0].embedding, dtype=np.float32)
+    async def aclose(self):
+        """Finish in-flight query embedding requests (shutdown)"""
+        await self.coalescer.aclose()
     
-    async def _get_embeddings_batch(self, texts: list[str], batch_size: int = 100) -> list[np.ndarray]:
-        """Get embeddings for multiple texts in batches"""
-        all_embeddings = []
+    async def embed(self, text: str) -> np.ndarray:
+        """Raw (unnormalized) embedding for one text, served from the query cache when possible"""
+        cached = self.query_cache.get(text)
+        if cached is not None:
+            return cached
         
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            response = await self.client.embeddings.create(
-                model=self.EMBEDDING_MODEL,
-                input=batch
-            )
-            batch_embeddings = [np.array(e.embedding, dtype=np.float32) for e in response.data]
-            all_embeddings.extend(batch_embeddings)
+        # Concurrent cache misses share one batched embeddings request
+        embedding = await self.coalescer.embed(text)
+        self.query_cache.put(text, embedding)
+        return embedding
+    
+    async def _get_embeddings_batch(self, texts: list[str], out: np.ndarray,
+                                    start_idx: int = 0, batch_size: int = 100):
+        """
+        Get embeddings for multiple texts in batches, written in place into
+        out[start_idx:start_idx + len(texts)] (a float32 (N, EMBEDDING_DIM) buffer).
+        Up to EMBED_MAX_IN_FLIGHT batches are requested concurrently; rows are
+        placed by index, so the row order always matches `texts`.
+        """
+        semaphore = asyncio.Semaphore(self.EMBED_MAX_IN_FLIGHT)
+        done = 0
+        
+        async def embed_batch(start: int):
+            nonlocal done
+            batch = texts[start:start + batch_size]
+            async with semaphore:
+                response = await self._create_embeddings_with_retry(batch)
+            for offset, e in enumerate(response.data):
+                out[start_idx + start + offset] = e.embedding
             
             # Progress logging
-            print(f"  📊 Embedded {min(i + batch_size, len(texts))}/{len(texts)} documents...")
+            done += len(batch)
+            print(f"  📊 Embedded {done}/{len(texts)} documents...")
         
-        return all_embeddings
+        await asyncio.gather(*(embed_batch(i) for i in range(0, len(texts), batch_size)))
+    
+    async def _create_embeddings_with_retry(self, batch: list[str]):
+        """Embeddings API call with jittered exponential backoff on 429/5xx"""
+        for attempt in range(self.EMBED_MAX_RETRIES):
+            # Small jitter so concurrent batches do not hit the API in lockstep
+            await asyncio.sleep(random.uniform(0, 0.2))
+            try:
+                return await self.client.embeddings.create(
+                    model=self.EMBEDDING_MODEL,
+                    input=batch
+                )
+            except (RateLimitError, InternalServerError, APIConnectionError) as e:
+                if attempt == self.EMBED_MAX_RETRIES - 1:
+                    raise
+                delay = 2 ** attempt + random.uniform(0, 1)
+                print(f"  ⚠️ Embedding batch failed ({e.__class__.__name__}), retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
     
     def _get_cache_path(self, base_path: Path) -> Path:
         """Get path to embeddings cache file"""
         return base_path / self.CACHE_FILE
     
-    def _load_cache(self, cache_path: Path) -> bool:
-        """Try to load embeddings from cache"""
-        if cache_path.exists():
+    def _get_docs_path(self, cache_path: Path) -> Path:
+        """Get path to the document list stored next to the embeddings cache"""
+        return cache_path.with_name(self.DOCS_CACHE_FILE)
+    
+    def _get_index_path(self, cache_path: Path) -> Path:
+        """Get path to the HNSW index file stored next to the embeddings cache"""
+        return cache_path.with_name(self.INDEX_FILE)
+    
+    def _build_ann_index(self):
+        """Build the HNSW index over the normalized embeddings (if enabled)"""
+        self.index = None
+        n_docs = len(self.embeddings)
+        if hnswlib is None or n_docs < self.HNSW_MIN_DOCS:
+            return
+        
+        index = hnswlib.Index(space="cosine", dim=self.embeddings.shape[1])
+        index.init_index(max_elements=n_docs, ef_construction=self.HNSW_EF_CONSTRUCTION, M=self.HNSW_M)
+        index.add_items(self.embeddings, np.arange(n_docs))
+        index.set_ef(self.HNSW_EF_SEARCH)
+        self.index = index
+        print(f"✅ HNSW index ready: {n_docs} vectors")
+    
+    def _quantize_embeddings(self):
+        """
+        Build a per-row symmetric int8 copy of the embeddings for the
+        brute-force scan (4x less memory traffic than float32).
+        
+        Only used with SimSIMD's integer kernels: NumPy has no int8 BLAS, so
+        without simsimd (or when HNSW serves queries) float32 is kept.
+        """
+        self.embeddings_int8 = None
+        self.int8_inv_scale = None
+        if simsimd is None or self.index is not None:
+            return
+        
+        max_abs = np.max(np.abs(self.embeddings), axis=1, keepdims=True) + 1e-10
+        scale = 127.0 / max_abs
+        self.embeddings_int8 = np.ascontiguousarray(
+            np.rint(self.embeddings * scale).astype(np.int8)
+        )
+        self.int8_inv_scale = (1.0 / scale).ravel().astype(np.float32)
+    
+    def _scan_int8(self, query_embedding: np.ndarray, top_k: int) -> np.ndarray:
+        """Shortlist candidate indices using the int8 embeddings"""
+        q_scale = 127.0 / (np.max(np.abs(query_embedding)) + 1e-10)
+        q_int8 = np.rint(query_embedding * q_scale).astype(np.int8)
+        dots = np.asarray(simsimd.cdist(q_int8[None, :], self.embeddings_int8, metric="dot"))[0]
+        approx = dots * self.int8_inv_scale  # Query scale is constant, ranking only
+        
+        n_candidates = top_k * self.INT8_OVERSAMPLE
+        if n_candidates >= len(approx):
+            return np.arange(len(approx))
+        return np.argpartition(-approx, n_candidates)[:n_candidates]
+    
+    def _load_ann_index(self, index_path: Path):
+        """Load a saved HNSW index, rebuilding it if missing or unreadable"""
+        self.index = None
+        n_docs = len(self.embeddings)
+        if hnswlib is None or n_docs < self.HNSW_MIN_DOCS:
+            return
+        
+        if index_path.exists():
             try:
-                with open(cache_path, 'rb') as f:
-                    cached = pickle.load(f)
-                    self.embeddings = cached['embeddings']
-                    self.documents = cached['documents']
-                    self.is_ready = True
-                    print(f"✅ Loaded {len(self.documents)} embeddings from cache")
-                    return True
+                index = hnswlib.Index(space="cosine", dim=self.embeddings.shape[1])
+                index.load_index(str(index_path), max_elements=n_docs)
+                if index.get_current_count() == n_docs:
+                    index.set_ef(self.HNSW_EF_SEARCH)
+                    self.index = index
+                    print("✅ Loaded HNSW index from cache")
+                    return
             except Exception as e:
-                print(f"⚠️ Cache load failed: {e}")
+                print(f"⚠️ HNSW index load failed: {e}")
+        
+        self._build_ann_index()
+        if self.index is not None:
+            self._save_ann_index(index_path)
+    
+    def _save_ann_index(self, index_path: Path):
+        """Save the HNSW index (if any) next to the embeddings cache"""
+        if self.index is None:
+            return
+        try:
+            self.index.save_index(str(index_path))
+        except Exception as e:
+            print(f"⚠️ HNSW index save failed: {e}")
+    
+    def _load_cache(self, cache_path: Path) -> bool:
+        """
+        Try to load embeddings from cache.
+        The matrix is memory-mapped, so startup does not copy it into RAM;
+        the OS page cache serves it and pages are warmed in the background.
+        """
+        docs_path = self._get_docs_path(cache_path)
+        if not (cache_path.exists() and docs_path.exists()):
+            return self._migrate_legacy_cache(cache_path)
+        
+        try:
+            embeddings = np.load(cache_path, mmap_mode='r')
+            if embeddings.dtype != np.float32 or not embeddings.flags['C_CONTIGUOUS']:
+                embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            with open(docs_path, 'r', encoding='utf-8') as f:
+                self.documents = json.load(f)
+            self.embeddings = embeddings
+            self._load_ann_index(self._get_index_path(cache_path))
+            self._quantize_embeddings()
+            if self.index is None and self.embeddings_int8 is None:
+                # Brute-force float32 scans read the whole mmap: fault it in now
+                threading.Thread(target=self._warm_pages, daemon=True).start()
+            self.is_ready = True
+            print(f"✅ Loaded {len(self.documents)} embeddings from cache")
+            return True
+        except Exception as e:
+            print(f"⚠️ Cache load failed: {e}")
         return False
     
+    def _warm_pages(self):
+        """Touch every page of the memory-mapped embeddings"""
+        np.add.reduce(self.embeddings, axis=None)
+    
+    def _migrate_legacy_cache(self, cache_path: Path) -> bool:
+        """Convert an old pickle cache to the .npy + .json format"""
+        legacy_path = cache_path.with_name(self.LEGACY_CACHE_FILE)
+        if not legacy_path.exists():
+            return False
+        
+        try:
+            with open(legacy_path, 'rb') as f:
+                cached = pickle.load(f)
+            self.embeddings = np.ascontiguousarray(cached['embeddings'], dtype=np.float32)
+            self.documents = cached['documents']
+            print(f"🔄 Migrating legacy embeddings cache {legacy_path.name}")
+        except Exception as e:
+            print(f"⚠️ Legacy cache load failed: {e}")
+            return False
+        
+        self._save_cache(cache_path)
+        return self._load_cache(cache_path)
+    
     def _save_cache(self, cache_path: Path):
         """Save embeddings to cache"""
         try:
-            with open(cache_path, 'wb') as f:
-                pickle.dump({
-                    'embeddings': self.embeddings,
-                    'documents': self.documents
-                }, f)
+            # Write to a temp file and swap it in: an older mmap of the same
+            # path keeps its (now unlinked) inode instead of being truncated
+            tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(self.embeddings, dtype=np.float32))
+            os.replace(tmp_path, cache_path)
+            with open(self._get_docs_path(cache_path), 'w', encoding='utf-8') as f:
+                json.dump(self.documents, f, ensure_ascii=False)
+            self._save_ann_index(self._get_index_path(cache_path))
             print(f"✅ Saved embeddings cache to {cache_path}")
         except Exception as e:
             print(f"⚠️ Cache save failed: {e}")
@@ -226,6 +938,28 @@ class LocalVectorStore:
         if text_fields is None:
             text_fields = ["judul", "cakupan"]
         
+        texts = [
+            " ".join(str(doc.get(f, ""))[:500] for f in text_fields)  # Limit length
+            for doc in documents
+        ]
+        await self.build_index_from_texts(texts, documents, cache_dir, force_rebuild)
+    
+    async def build_index_from_texts(self, texts: list[str], documents: list[dict],
+                                     cache_dir: Path = None, force_rebuild: bool = False):
+        """
+        Build vector index from pre-joined document texts.
+        
+        Args:
+            texts: One text to embed per document (same order as documents)
+            documents: List of document dicts
+            cache_dir: Directory to store/load cache
+            force_rebuild: If True, rebuild even if cache exists
+        """
+        if cache_dir:
+            self.query_cache = EmbeddingCache(
+                self.EMBEDDING_MODEL, db_path=cache_dir / self.QUERY_CACHE_FILE
+            )
+        
         # Try loading from cache first
         if cache_dir and not force_rebuild:
             cache_path = self._get_cache_path(cache_dir)
@@ -238,19 +972,15 @@ class LocalVectorStore:
         print(f"🔨 Building vector index for {len(documents)} documents...")
         self.documents = documents
         
-        # Prepare texts for embedding
-        texts = []
-        for doc in documents:
-            combined = " ".join(str(doc.get(f, ""))[:500] for f in text_fields)  # Limit length
-            texts.append(combined)
+        # Get embeddings in batches, straight into a C-ordered float32 buffer
+        # so the query matmul is a single BLAS sgemv
+        self.embeddings = np.empty((len(texts), self.EMBEDDING_DIM), dtype=np.float32)
+        await self._get_embeddings_batch(texts, self.embeddings)
         
-        # Get embeddings in batches
-        embedding_list = await self._get_embeddings_batch(texts)
-        self.embeddings = np.vstack(embedding_list)
-        
-        # Normalize for cosine similarity
-        norms = np.linalg.norm(self.embeddings, axis=1, keepdims=True)
-        self.embeddings = self.embeddings / (norms + 1e-10)
+        # Normalize for cosine similarity (in place)
+        self.embeddings /= np.linalg.norm(self.embeddings, axis=1, keepdims=True) + 1e-10
+        self._build_ann_index()
+        self._quantize_embeddings()
         
         self.is_ready = True
         print(f"✅ Vector index ready: {self.embeddings.shape}")
@@ -271,14 +1001,37 @@ class LocalVectorStore:
             return []
         
         # Get query embedding
-        query_embedding = await self._get_embedding(query)
+        query_embedding = await self.embed(query)
         query_embedding = query_embedding / (np.linalg.norm(query_embedding) + 1e-10)
         
+        if top_k <= 0:
+            return []
+        
+        if self.index is not None:
+            # Approximate nearest neighbours, O(log N) per query
+            k = min(top_k, len(self.embeddings))
+            self.index.set_ef(max(self.HNSW_EF_SEARCH, k))
+            labels, distances = self.index.knn_query(query_embedding, k=k)
+            # hnswlib cosine distance is 1 - cosine similarity
+            return [(int(idx), float(1.0 - dist)) for idx, dist in zip(labels[0], distances[0])]
+        
+        if self.embeddings_int8 is not None:
+            # int8 SIMD shortlist (runtime-dispatched AVX2/AVX-512 VNNI/NEON),
+            # then exact float32 scores for the shortlist only
+            candidates = self._scan_int8(query_embedding, top_k)
+            similarities = self.embeddings[candidates] @ query_embedding
+            order = np.argsort(-similarities)[:top_k]
+            return [(int(candidates[i]), float(similarities[i])) for i in order]
+        
         # Cosine similarity (embeddings are normalized)
-        similarities = np.dot(self.embeddings, query_embedding)
+        similarities = self.embeddings @ query_embedding
         
-        # Get top-k indices
-        top_indices = np.argsort(similarities)[::-1][:top_k]
+        # Get top-k indices: O(N) partition, then sort only the k winners
+        if top_k < len(similarities):
+            top_indices = np.argpartition(-similarities, top_k)[:top_k]
+        else:
+            top_indices = np.arange(len(similarities))
+        top_indices = top_indices[np.argsort(-similarities[top_indices])]
         
         results = [(int(idx), float(similarities[idx])) for idx in top_indices]
         return results
@@ -290,7 +1043,8 @@ class LocalVectorStore:
 
 def reciprocal_rank_fusion(
     rankings: list[list[tuple[int, float]]], 
-    k: int = 60
+    k: int = 60,
+    key=None
 ) -> list[tuple[int, float]]:
     """
     Combine multiple rankings using Reciprocal Rank Fusion.
@@ -300,6 +1054,8 @@ def reciprocal_rank_fusion(
     Args:
         rankings: List of ranking lists, each containing (doc_id, score) tuples
         k: Constant to prevent high scores for top-ranked docs (default: 60)
+        key: Optional doc_id -> group key (e.g. KBLI code); only the
+            best-scoring doc of each group is kept
     
     Returns:
         Combined ranking as list of (doc_id, rrf_score) tuples
@@ -314,6 +1070,13 @@ def reciprocal_rank_fusion(
     
     # Sort by RRF score descending
     sorted_results = sorted(rrf_scores.items(), key=lambda x: x[1], reverse=True)
+    
+    if key is not None:
+        seen = set()
+        sorted_results = [
+            (doc_id, score) for doc_id, score in sorted_results
+            if not ((group := key(doc_id)) in seen or seen.add(group))
+        ]
     return sorted_results
 
 
@@ -321,74 +1084,104 @@ def reciprocal_rank_fusion(
 # Semantic Re-ranker
 # ============================================================================
 
+# Lightweight view of a fused candidate: only the fields the reranker reads.
+# Full document dicts are materialized for the final top-k only.
+Candidate = namedtuple('Candidate', 'doc_idx code judul cakupan rrf')
+
+
 class SemanticReranker:
     """
     LLM-based semantic re-ranker for final relevance scoring.
     Uses GPT to judge relevance between query and candidates.
+    
+    The model is forced to call the rank_candidates tool, so the rankings
+    arrive as schema-shaped arguments instead of free-form text.
     """
     
+    MAX_CANDIDATES = 15
+    # Completion budget per requested ranking (index, relevance and a
+    # reason of at most 10 words), plus a fixed overhead for the call
+    RANK_TOKENS_PER_ITEM = 50
+    RANK_TOKENS_OVERHEAD = 40
+    
+    RANK_ITEM_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "index": {"type": "integer", "description": "Nomor kandidat (1-based)"},
+            "relevance": {"type": "number", "description": "0.0-1.0"},
+            "reason": {"type": "string", "description": "Alasan singkat, maks 10 kata"}
+        },
+        "required": ["index", "relevance", "reason"]
+    }
+    RANK_TOOL_CHOICE = {"type": "function", "function": {"name": "rank_candidates"}}
+    
     def __init__(self, openai_client: AsyncOpenAI):
         self.client = openai_client
     
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _rank_tool(max_items: int) -> dict:
+        """rank_candidates tool schema allowing at most max_items rankings"""
+        return {
+            "type": "function",
+            "function": {
+                "name": "rank_candidates",
+                "description": "Ranking kandidat KBLI berdasarkan relevansi terhadap query",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "rankings": {
+                            "type": "array",
+                            "maxItems": max_items,
+                            "items": SemanticReranker.RANK_ITEM_SCHEMA
+                        }
+                    },
+                    "required": ["rankings"]
+                }
+            }
+        }
+    
     async def rerank(
         self, 
         query: str, 
-        candidates: list[dict], 
+        candidates: list[Candidate], 
         top_k: int = 5
-    ) -> list[dict]:
+    ) -> list[tuple[Candidate, Optional[float], Optional[str]]]:
         """
         Re-rank candidates using LLM semantic understanding.
         
         Args:
             query: Original user query
-            candidates: List of candidate documents with 'kode_kbli', 'judul', 'cakupan'
+            candidates: List of Candidate tuples (code, judul, cakupan, ...)
             top_k: Number of results to return
         
         Returns:
-            Re-ranked list of candidates with added 'relevance_score' and 'reasoning'
+            Re-ranked list of (candidate, relevance_score, reasoning);
+            score and reasoning are None when the LLM call fails
         """
         if not candidates:
             return []
         
         # Limit candidates to prevent token overflow
-        candidates = candidates[:15]
+        candidates = candidates[:self.MAX_CANDIDATES]
         
-        # Build candidate list for prompt
+        # Build candidate list for prompt (compact view: fewer input tokens)
         candidate_str = "\n".join([
-            f"{i+1}. KODE: {c.get('kode_kbli', c.get('kode', 'N/A'))} | JUDUL: {c.get('judul', '')[:100]} | CAKUPAN: {c.get('cakupan', '')[:150]}"
+            f"{i+1}|{c.code or 'N/A'}|{c.judul[:100]}|{c.cakupan[:80]}"
             for i, c in enumerate(candidates)
         ])
         
-        system_prompt = """Anda adalah ahli klasifikasi KBLI 2020 BPS Indonesia.
-Tugas: Evaluasi relevansi setiap kandidat KBLI terhadap query pengguna.
-
-ATURAN PENTING:
-1. Fokus pada AKTIVITAS UTAMA yang dimaksud user
-2. Bedakan: PERDAGANGAN (jual beli) vs INDUSTRI (produksi) vs JASA (layanan)
-3. Perhatikan konteks informal bahasa Indonesia
-
-OUTPUT FORMAT (JSON only, no markdown):
-{
-  "rankings": [
-    {
-      "rank": 1,
-      "index": <nomor kandidat 1-based>,
-      "relevance": <0.0-1.0>,
-      "reason": "<alasan singkat>"
-    },
-    ...
-  ]
-}
-
-Urutkan berdasarkan relevansi tertinggi. Hanya sertakan kandidat yang RELEVAN (relevance > 0.3)."""
+        system_prompt = """Ahli KBLI 2020 BPS. Nilai relevansi kandidat KBLI (index|kode|judul|cakupan) terhadap query.
+Fokus aktivitas utama; bedakan PERDAGANGAN vs INDUSTRI vs JASA; pahami bahasa informal.
+Panggil rank_candidates, urut relevansi tertinggi, hanya relevance > 0.3."""
 
         user_prompt = f"""Query: "{query}"
+{candidate_str}"""
 
-Kandidat KBLI:
-{candidate_str}
-
-Evaluasi dan ranking berdasarkan relevansi. Output JSON saja."""
-
+        # Only top_k rankings are used: ask for no more, and budget tokens
+        # for that many so the tool arguments are never cut off
+        n_rankings = max(1, min(top_k, len(candidates)))
+        
         try:
             response = await self.client.chat.completions.create(
                 model="gpt-4o-mini",
@@ -396,19 +1189,16 @@ Evaluasi dan ranking berdasarkan relevansi. Output JSON saja."""
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": user_prompt}
                 ],
+                tools=[self._rank_tool(n_rankings)],
+                tool_choice=self.RANK_TOOL_CHOICE,
                 temperature=0,
-                max_tokens=1000
+                max_tokens=self.RANK_TOKENS_OVERHEAD + self.RANK_TOKENS_PER_ITEM * n_rankings
             )
+            if response.choices[0].finish_reason == "length":
+                print(f"⚠️ Reranking output hit max_tokens for {query!r}")
             
-            content = response.choices[0].message.content.strip()
-            
-            # Parse JSON response
-            if "```" in content:
-                match = re.search(r'```(?:json)?\s*(.*?)```', content, re.DOTALL)
-                if match:
-                    content = match.group(1).strip()
-            
-            result = json.loads(content)
+            arguments = response.choices[0].message.tool_calls[0].function.arguments
+            result = orjson.loads(arguments) if orjson is not None else json.loads(arguments)
             rankings = result.get("rankings", [])
             
             # Map back to candidates with scores
@@ -416,17 +1206,14 @@ Evaluasi dan ranking berdasarkan relevansi. Output JSON saja."""
             for r in rankings[:top_k]:
                 idx = r.get("index", 1) - 1  # Convert to 0-based
                 if 0 <= idx < len(candidates):
-                    candidate = candidates[idx].copy()
-                    candidate["relevance_score"] = r.get("relevance", 0.0)
-                    candidate["reasoning"] = r.get("reason", "")
-                    reranked.append(candidate)
+                    reranked.append((candidates[idx], r.get("relevance", 0.0), r.get("reason", "")))
             
             return reranked
             
         except Exception as e:
-            print(f"Reranking error: {e}")
+            print(f"⚠️ Reranking failed, keeping fusion order for {query!r}: {e}")
             # Fallback: return top candidates without reranking
-            return candidates[:top_k]
+            return [(c, None, None) for c in candidates[:top_k]]
 
 
 # ============================================================================
@@ -443,14 +1230,20 @@ class HybridSearchEngine:
     3. Semantic Re-ranking
     """
     
-    def __init__(self, openai_client: AsyncOpenAI):
+    def __init__(self, openai_client: AsyncOpenAI, use_numba: bool = False):
         self.client = openai_client
         self.bm25 = BM25()
+        self.use_numba = use_numba  # Score BM25 with the Numba kernel (BM25.activate_numba)
         self.vector_store = LocalVectorStore(openai_client)
         self.reranker = SemanticReranker(openai_client)
         self.documents: list[dict] = []
+        self.doc_codes: list[str] = []  # kode_kbli per document, for RRF dedup
         self.is_ready = False
     
+    async def aclose(self):
+        """Finish in-flight background work (shutdown)"""
+        await self.vector_store.aclose()
+    
     async def initialize(self, documents: list[dict], cache_dir: Path = None):
         """
         Initialize search engine with documents.
@@ -463,18 +1256,35 @@ class HybridSearchEngine:
         ]
         
         self.documents = valid_docs
+        # Several entries share a KBLI code; RRF keeps the best one per code
+        self.doc_codes = [d.get("kode_kbli", "") for d in valid_docs]
         print(f"📚 Initializing Hybrid Search with {len(valid_docs)} valid KBLI entries...")
         
-        # Build BM25 index (fast, synchronous)
-        print("🔨 Building BM25 index...")
-        self.bm25.fit(valid_docs, text_fields=["judul", "hierarki", "cakupan"])
-        print(f"✅ BM25 index ready: {len(self.bm25.idf)} unique terms")
+        # Stringify each field once; both indexes are built from these
+        judul = [str(d.get("judul", "")) for d in valid_docs]
+        hierarki = [str(d.get("hierarki", "")) for d in valid_docs]
+        cakupan = [str(d.get("cakupan", "")) for d in valid_docs]
+        
+        # Build BM25 index (fast, synchronous), or reuse the saved one
+        bm25_texts = [f"{j} {h} {c}" for j, h, c in zip(judul, hierarki, cakupan)]
+        corpus_hash = BM25.corpus_hash(bm25_texts)
+        bm25_dir = cache_dir / BM25.INDEX_DIR if cache_dir else None
+        if bm25_dir and self.bm25.load(bm25_dir, corpus_hash, valid_docs):
+            print(f"✅ Loaded BM25 index from cache: {len(self.bm25.idf)} unique terms")
+        else:
+            print("🔨 Building BM25 index...")
+            self.bm25.fit_from_texts(bm25_texts, valid_docs)
+            print(f"✅ BM25 index ready: {len(self.bm25.idf)} unique terms")
+            if bm25_dir:
+                self.bm25.save(bm25_dir, corpus_hash)
+        if self.use_numba and self.bm25.activate_numba():
+            print("✅ BM25 scoring with the Numba JIT kernel")
         
-        # Build vector store (async, may use cache)
+        # Build vector store (async, may use cache); texts are length-limited
         print("🔨 Building Vector Store...")
-        await self.vector_store.build_index(
-            valid_docs, 
-            text_fields=["judul", "cakupan"],
+        await self.vector_store.build_index_from_texts(
+            [f"{j[:500]} {c[:500]}" for j, c in zip(judul, cakupan)],
+            valid_docs,
             cache_dir=cache_dir
         )
         
@@ -510,32 +1320,50 @@ class HybridSearchEngine:
         
         bm25_results, vector_results = await asyncio.gather(bm25_task, vector_task)
         
+        return await self._fuse_and_rerank(
+            query, bm25_results, vector_results, top_k, use_reranking, retrieval_top_k
+        )
+    
+    async def _fuse_and_rerank(
+        self,
+        query: str,
+        bm25_results: list[tuple[int, float]],
+        vector_results: list[tuple[int, float]],
+        top_k: int,
+        use_reranking: bool,
+        retrieval_top_k: int
+    ) -> dict:
+        """Fuse the retrieval rankings with RRF and re-rank the candidates"""
         # ====== STAGE 2: Reciprocal Rank Fusion ======
-        fused_ranking = reciprocal_rank_fusion([bm25_results, vector_results], k=60)
-        
-        # Get candidate documents
-        candidates = []
-        seen_codes = set()
-        for doc_idx, rrf_score in fused_ranking[:retrieval_top_k]:
-            doc = self.documents[doc_idx]
-            code = doc.get("kode_kbli", "")
-            if code not in seen_codes:
-                seen_codes.add(code)
-                candidates.append({
-                    **doc,
-                    "rrf_score": rrf_score,
-                    "_doc_idx": doc_idx
-                })
+        fused_ranking = reciprocal_rank_fusion(
+            [bm25_results, vector_results], k=60, key=self.doc_codes.__getitem__
+        )
+        
+        # Get candidate documents (already unique per KBLI code)
+        documents = self.documents
+        candidates = [
+            Candidate(
+                doc_idx, self.doc_codes[doc_idx],
+                documents[doc_idx].get("judul", ""), documents[doc_idx].get("cakupan", ""),
+                rrf_score
+            )
+            for doc_idx, rrf_score in fused_ranking[:retrieval_top_k]
+        ]
         
         # ====== STAGE 3: Semantic Re-ranking ======
         if use_reranking and candidates:
-            final_results = await self.reranker.rerank(query, candidates, top_k)
+            ranked = await self.reranker.rerank(query, candidates, top_k)
         else:
-            final_results = candidates[:top_k]
+            ranked = [(c, None, None) for c in candidates[:top_k]]
         
-        # Clean up internal fields
-        for r in final_results:
-            r.pop("_doc_idx", None)
+        # Materialize result dicts for the final top-k only
+        final_results = []
+        for c, relevance, reason in ranked:
+            result = {**self.documents[c.doc_idx], "rrf_score": c.rrf}
+            if relevance is not None:
+                result["relevance_score"] = relevance
+                result["reasoning"] = reason
+            final_results.append(result)
         
         return {
             "query": query,
@@ -546,8 +1374,11 @@ class HybridSearchEngine:
         }
     
     async def _bm25_search(self, query: str, top_k: int) -> list[tuple[int, float]]:
-        """Wrapper for BM25 search (sync but wrapped for gather)"""
-        return self.bm25.search(query, top_k)
+        """
+        Run the CPU-bound BM25 search in a worker thread so it overlaps with
+        the embedding request instead of blocking the event loop.
+        """
+        return await asyncio.to_thread(self.bm25.search, query, top_k)
     
     async def search_simple(self, query: str, top_k: int = 5) -> list[dict]:
         """
@@ -4,27 +4,49 @@ Pattern matching + AI-Enhanced Hybrid Search
 Endpoints: /lookup, /lookup/batch, /search, /search/smart, /search/hybrid
 """
 
+import asyncio
+import datetime
+import heapq
 import json
 import re
 import os
+import sys
+import time
+import zipfile
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
 from pathlib import Path
-from typing import Optional
+from typing import NamedTuple, Optional
 from io import BytesIO
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
 from pydantic import BaseModel
 import openpyxl
+import python_calamine
+import xlsxwriter
 from openpyxl.styles import Font, PatternFill, Alignment
 from dotenv import load_dotenv
 from openai import OpenAI, AsyncOpenAI
 
+try:
+    import orjson
+except ImportError:  # Optional: SSE payloads fall back to json.dumps
+    orjson = None
+
+try:
+    import marisa_trie
+except ImportError:  # Optional: /autocomplete falls back to scanning every entry
+    marisa_trie = None
+
 # Import Hybrid Search Engine
 try:
-    from backend.hybrid_search import HybridSearchEngine
+    from backend.hybrid_search import HybridSearchEngine, MicroBatcher
 except ImportError:
-    from hybrid_search import HybridSearchEngine
+    from hybrid_search import HybridSearchEngine, MicroBatcher
 
 # Load environment variables
 load_dotenv()
@@ -41,10 +63,22 @@ try:
 except Exception as e:
     print(f"⚠️ OpenAI initialization failed: {e}")
 
+# Local copy of fastapi.responses.ORJSONResponse: FastAPI deprecates its own
+# class, so importing it would warn (and eventually break) on upgrade.
+class ORJSONResponse(JSONResponse):
+    """JSON response serialized by orjson (used as the app default when installed)"""
+    
+    def render(self, content) -> bytes:
+        # Content arrives via jsonable_encoder, which keeps int/None dict keys;
+        # OPT_NON_STR_KEYS stringifies them exactly like json.dumps instead of
+        # raising, so bodies match JSONResponse byte for byte.
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
 app = FastAPI(
     title="KBLI 2020 Code Lookup",
     description="Pattern-matching + AI-Enhanced Hybrid Semantic Search for KBLI codes",
-    version="3.0.0"  # Major version bump for Hybrid Search
+    version="3.0.0",  # Major version bump for Hybrid Search
+    default_response_class=ORJSONResponse if orjson is not None else JSONResponse
 )
 
 # Global Hybrid Search Engine
@@ -60,14 +94,39 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global lookup dictionary: kode -> info
-kbli_lookup: dict[str, dict] = {}
+class KBLIEntry(NamedTuple):
+    """One KBLI code. A tuple: cheaper to store and read than a per-entry dict."""
+    kode: str
+    judul: str
+    hierarki: str  # Interned: sibling codes share the same hierarchy path
+    cakupan: str
+    metadata: dict
+
+# Global lookup dictionary: kode -> entry (one key per entry)
+kbli_lookup: dict[str, KBLIEntry] = {}
+# Alternative spellings -> kbli_lookup key (zero-padded short codes), kept
+# out of kbli_lookup so search endpoints do not see each entry twice
+kbli_alias: dict[str, str] = {}
 kbli_raw_data: list[dict] = []  # Raw data for hybrid search
 
+# Search indexes, built once in startup(). Entries are positions in kbli_lookup
+# order; kbli_search_text holds the lowercased
+# (judul, hierarki, cakupan, "judul hierarki cakupan") of each entry.
+kbli_search_keys: list[str] = []
+kbli_search_text: list[tuple[str, str, str, str]] = []
+kbli_title_words: list[list[str]] = []  # judul words, "," and "." stripped
+kbli_word_index: dict[str, list[int]] = {}  # whitespace-delimited word -> positions
+kbli_code_prefixes: dict[str, list[int]] = {}  # every prefix of each kode -> positions
+
+# /autocomplete prefix tries (marisa_trie.RecordTrie, key -> (position,))
+code_trie = None   # kode
+title_trie = None  # lowercased judul
+word_trie = None   # each word of the lowercased judul
+
 @app.on_event("startup")
 async def startup():
     """Load KBLI data into memory and initialize Hybrid Search Engine"""
-    global kbli_lookup, kbli_raw_data, hybrid_search_engine, async_openai_client
+    global kbli_lookup, kbli_alias, kbli_raw_data, hybrid_search_engine, async_openai_client
     
     json_path = Path(__file__).parent.parent / "kbli_parsed_fast.json"
     if not json_path.exists():
@@ -85,26 +144,31 @@ async def startup():
         code = entry.get("kode_kbli", "").strip()
         if code:
             # Store both original and zero-padded versions
-            kbli_lookup[code] = {
-                "kode": code,
-                "judul": entry.get("judul", ""),
-                "hierarki": entry.get("hierarki", ""),
-                "cakupan": entry.get("cakupan", "")[:500],  # Truncate cakupan
-                "metadata": entry.get("metadata", {})
-            }
-            # Also store padded version for 5-digit lookup
+            kbli_lookup[code] = KBLIEntry(
+                kode=code,
+                judul=entry.get("judul", ""),
+                hierarki=sys.intern(entry.get("hierarki", "")),
+                cakupan=entry.get("cakupan", "")[:500],  # Truncate cakupan
+                metadata=entry.get("metadata", {})
+            )
+            # Also accept the padded version for 5-digit lookup
             if len(code) < 5 and code.isdigit():
-                padded = code.zfill(5)
-                kbli_lookup[padded] = kbli_lookup[code]
+                kbli_alias[code.zfill(5)] = code
     
+    _lookup_code_cached.cache_clear()
     print(f"✅ Loaded {len(kbli_lookup)} KBLI entries into lookup dictionary")
     
+    build_search_index()
+    
     # Initialize Hybrid Search Engine
     api_key = os.getenv("OPENAI_API_KEY")
     if api_key:
         try:
             async_openai_client = AsyncOpenAI(api_key=api_key)
-            hybrid_search_engine = HybridSearchEngine(async_openai_client)
+            hybrid_search_engine = HybridSearchEngine(
+                async_openai_client,
+                use_numba=os.getenv("BM25_NUMBA", "").lower() in ("1", "true", "yes")
+            )
             
             # Initialize with embeddings cache in parent directory
             cache_dir = Path(__file__).parent.parent
@@ -117,6 +181,94 @@ async def startup():
     else:
         print("⚠️ No OPENAI_API_KEY - Hybrid Search disabled")
 
+@app.on_event("shutdown")
+async def shutdown():
+    """Let in-flight micro-batched API calls finish before the loop closes"""
+    await expansion_batcher.aclose()
+    if hybrid_search_engine is not None:
+        await hybrid_search_engine.aclose()
+
+def build_search_index():
+    """
+    Precompute lowercased /search texts and an inverted index over their
+    whitespace-delimited words.
+    
+    /search matches query words as substrings, and a query word has no
+    whitespace, so it can only occur inside a single indexed word: the
+    union of postings of every indexed word containing it is an exact
+    candidate set.
+    """
+    global kbli_search_keys, kbli_search_text, kbli_title_words, kbli_word_index, kbli_code_prefixes
+    
+    kbli_search_keys = list(kbli_lookup)
+    code_prefixes: dict[str, list[int]] = {}
+    for pos, code in enumerate(kbli_search_keys):
+        for n in range(1, len(code) + 1):
+            code_prefixes.setdefault(code[:n], []).append(pos)
+    kbli_code_prefixes = code_prefixes
+    kbli_search_text = []
+    kbli_title_words = []
+    word_index: dict[str, list[int]] = {}
+    for pos, info in enumerate(kbli_lookup.values()):
+        judul_lower = info.judul.lower()
+        hierarki_lower = info.hierarki.lower()
+        cakupan_lower = info.cakupan.lower()
+        searchable = f"{info.judul} {info.hierarki} {info.cakupan}".lower()
+        kbli_search_text.append((judul_lower, hierarki_lower, cakupan_lower, searchable))
+        kbli_title_words.append(judul_lower.replace(",", "").replace(".", "").split())
+        for word in set(searchable.split()):
+            word_index.setdefault(word, []).append(pos)
+    kbli_word_index = word_index
+    _matching_positions.cache_clear()
+    print(f"✅ Search index ready: {len(kbli_word_index)} words")
+    
+    build_autocomplete_index()
+
+def build_autocomplete_index():
+    """Build the /autocomplete prefix tries (no-op without marisa-trie)"""
+    global code_trie, title_trie, word_trie
+    
+    if marisa_trie is None:
+        print("⚠️ marisa-trie not installed - autocomplete uses a full scan")
+        return
+    
+    code_items, title_items, word_items = [], [], []
+    for pos, (code, (judul_lower, *_)) in enumerate(zip(kbli_search_keys, kbli_search_text)):
+        code_items.append((code, (pos,)))
+        if judul_lower:
+            title_items.append((judul_lower, (pos,)))
+        for word in set(judul_lower.split()):
+            word_items.append((word, (pos,)))
+    
+    code_trie = marisa_trie.RecordTrie("<I", code_items)
+    title_trie = marisa_trie.RecordTrie("<I", title_items)
+    word_trie = marisa_trie.RecordTrie("<I", word_items)
+    _autocomplete_hits.cache_clear()
+
+@lru_cache(maxsize=4096)
+def _matching_positions(query_word: str) -> frozenset[int]:
+    """Positions of entries whose searchable text contains query_word"""
+    positions = set()
+    for word, word_positions in kbli_word_index.items():
+        if query_word in word:
+            positions.update(word_positions)
+    return frozenset(positions)
+
+def _phrase_candidates(phrase: str) -> Optional[frozenset[int]]:
+    """
+    Superset of the entries whose judul, hierarki or cakupan contains phrase:
+    they must contain each of its whitespace-separated parts.
+    Returns None for a blank phrase, which every entry contains.
+    """
+    parts = phrase.split()
+    if not parts:
+        return None
+    return frozenset.intersection(*(_matching_positions(part) for part in parts))
+
+# KBLI code patterns, compiled once for the batch hot path
+_KBLI_5DIGIT_RE = re.compile(r'\b(\d{5})\b')  # Standard 5-digit KBLI
+_KBLI_SHORT_RE = re.compile(r'\b(\d{2,4})\b')  # Category/golongan prefixes
+
 def extract_kbli_codes(text: str) -> list[str]:
     """Extract potential KBLI codes from text using regex"""
     if not text:
@@ -124,32 +276,47 @@ def extract_kbli_codes(text: str) -> list[str]:
     
     text = str(text).strip()
     
+    # Fast path: the whole cell is one digit run (the common "47111" case).
+    # It is a single \b-bounded match iff it has 2-5 digits; isdecimal()
+    # accepts exactly the characters \d matches.
+    if text.isdecimal():
+        return [text] if 2 <= len(text) <= 5 else []
+    
     # Pattern: 5-digit numbers (standard KBLI)
-    pattern_5digit = r'\b(\d{5})\b'
-    codes = re.findall(pattern_5digit, text)
+    codes = _KBLI_5DIGIT_RE.findall(text)
     
     # Also try 2-4 digit if nothing found (might be category/golongan)
     if not codes:
-        pattern_short = r'\b(\d{2,4})\b'
-        codes = re.findall(pattern_short, text)
+        codes = _KBLI_SHORT_RE.findall(text)
     
     return list(dict.fromkeys(codes))  # Remove duplicates, preserve order
 
+@lru_cache(maxsize=4096)
+def _lookup_code_cached(code: str) -> Optional[KBLIEntry]:
+    """
+    Entry for a stripped KBLI code, or None. Memoized: batch uploads repeat
+    the same few codes across many rows.
+    """
+    # Normalize once: short numeric codes are looked up zero-padded
+    key = code.zfill(5) if len(code) < 5 and code.isdigit() else code
+    info = kbli_lookup.get(key)
+    
+    # Padded short codes resolve through the alias map
+    if info is None and key != code:
+        alias = kbli_alias.get(key)
+        info = kbli_lookup[alias] if alias is not None else None
+    return info
+
 def lookup_code(code: str) -> dict:
     """Lookup a single KBLI code"""
     code = str(code).strip()
+    info = _lookup_code_cached(code)
     
-    # Try exact match first
-    if code in kbli_lookup:
-        return {**kbli_lookup[code], "status": "found"}
+    if info is not None:
+        # metadata is copied: the cached entry must not see caller mutations
+        return {**info._asdict(), "metadata": dict(info.metadata), "status": "found"}
     
-    # Try zero-padded version
-    if code.isdigit():
-        padded = code.zfill(5)
-        if padded in kbli_lookup:
-            return {**kbli_lookup[padded], "status": "found"}
-    
-    # Not found
+    # Not found (built fresh, so no two results share a metadata dict)
     return {
         "kode": code,
         "judul": "",
@@ -190,7 +357,7 @@ async def stats():
     """Get statistics about loaded KBLI data"""
     return {
         "total_entries": len(kbli_lookup),
-        "sample_codes": list(kbli_lookup.keys())[:10]
+        "sample_codes": list(islice(kbli_lookup, 10))
     }
 
 @app.get("/search")
@@ -203,11 +370,20 @@ async def search_kbli(q: str, limit: int = 10):
         return {"results": [], "query": q, "total": 0}
     
     q_lower = q.lower()
-    results = []
+    query_words = q_lower.split()
+    scored = []  # (score, position) of every match
+    
+    if query_words:
+        # Only entries containing at least one query word can score
+        candidates = set()
+        for word in query_words:
+            candidates |= _matching_positions(word)
+        positions = sorted(candidates)  # Keep kbli_lookup order for ties
+    else:
+        positions = range(len(kbli_search_keys))
     
-    for code, info in kbli_lookup.items():
-        # Search in title, hierarchy, and cakupan
-        searchable = f"{info['judul']} {info['hierarki']} {info.get('cakupan', '')}".lower()
+    for pos in positions:
+        judul_lower, _, _, searchable = kbli_search_text[pos]
         
         # Simple relevance scoring
         score = 0
@@ -215,35 +391,63 @@ async def search_kbli(q: str, limit: int = 10):
             # Exact substring match
             score = 100
             # Bonus if in title
-            if q_lower in info['judul'].lower():
+            if q_lower in judul_lower:
                 score += 50
             # Bonus if at start
             if searchable.startswith(q_lower):
                 score += 25
         else:
             # Fuzzy match - check if all query words are present
-            query_words = q_lower.split()
             matches = sum(1 for word in query_words if word in searchable)
             if matches > 0:
                 score = (matches / len(query_words)) * 50
         
         if score > 0:
-            results.append({
-                "code": code,
-                "judul": info["judul"],
-                "hierarki": info["hierarki"],
-                "score": score
-            })
+            scored.append((score, pos))
     
-    # Sort by score descending
-    results.sort(key=lambda x: x["score"], reverse=True)
+    # Top `limit` by score descending (nlargest keeps scan order for ties)
+    results = []
+    for score, pos in heapq.nlargest(limit, scored, key=itemgetter(0)):
+        code = kbli_search_keys[pos]
+        info = kbli_lookup[code]
+        results.append({
+            "code": code,
+            "judul": info.judul,
+            "hierarki": info.hierarki,
+            "score": score
+        })
     
     return {
-        "results": results[:limit],
+        "results": results,
         "query": q,
-        "total": len(results)
+        "total": len(scored)
     }
 
+def _suggestion(kind: str, code: str, info: KBLIEntry) -> dict:
+    """One /autocomplete suggestion"""
+    if kind == "code":
+        match = f"{code} - {info.judul[:60]}..."
+    else:
+        match = f"{info.judul[:60]}... ({code})"
+    return {"type": kind, "code": code, "judul": info.judul, "match": match}
+
+@lru_cache(maxsize=4096)
+def _autocomplete_hits(q: str, max_matches: int) -> tuple[tuple[int, str], ...]:
+    """
+    (position, match type) of the first max_matches entries, in kbli_lookup
+    order, matching q by code, title or title-word prefix - the same entries
+    the scan collects. Memoized: every keystroke re-sends a short prefix
+    that other users just typed.
+    """
+    q_lower = q.lower()
+    code_hits = {pos for _, (pos,) in code_trie.items(q)}
+    title_hits = {pos for _, (pos,) in title_trie.items(q_lower)}
+    word_hits = {pos for _, (pos,) in word_trie.items(q_lower)}
+    return tuple(
+        (pos, "code" if pos in code_hits else "title" if pos in title_hits else "word")
+        for pos in sorted(code_hits | title_hits | word_hits)[:max_matches]
+    )
+
 @app.get("/autocomplete")
 async def autocomplete(q: str, limit: int = 5):
     """
@@ -255,53 +459,66 @@ async def autocomplete(q: str, limit: int = 5):
     
     q_lower = q.lower()
     suggestions = []
+    max_matches = max(limit * 3, 1)  # Get more for sorting
     
-    for code, info in kbli_lookup.items():
-        # Match by code prefix
-        if code.startswith(q):
-            suggestions.append({
-                "type": "code",
-                "code": code,
-                "judul": info["judul"],
-                "match": f"{code} - {info['judul'][:60]}..."
-            })
-        # Match by title prefix
-        elif info['judul'].lower().startswith(q_lower):
-            suggestions.append({
-                "type": "title",
-                "code": code,
-                "judul": info["judul"],
-                "match": f"{info['judul'][:60]}... ({code})"
-            })
-        # Match by word in title
-        elif any(word.startswith(q_lower) for word in info['judul'].lower().split()):
-            suggestions.append({
-                "type": "word",
-                "code": code,
-                "judul": info["judul"],
-                "match": f"{info['judul'][:60]}... ({code})"
-            })
-        
-        if len(suggestions) >= limit * 3:  # Get more for sorting
-            break
+    if code_trie is not None:
+        for pos, kind in _autocomplete_hits(q, max_matches):
+            code = kbli_search_keys[pos]
+            suggestions.append(_suggestion(kind, code, kbli_lookup[code]))
+    else:
+        for code, info in kbli_lookup.items():
+            # Match by code prefix
+            if code.startswith(q):
+                suggestions.append(_suggestion("code", code, info))
+            # Match by title prefix
+            elif info.judul.lower().startswith(q_lower):
+                suggestions.append(_suggestion("title", code, info))
+            # Match by word in title
+            elif any(word.startswith(q_lower) for word in info.judul.lower().split()):
+                suggestions.append(_suggestion("word", code, info))
+            
+            if len(suggestions) >= max_matches:
+                break
     
     # Prioritize: code matches > title prefix > word matches
-    suggestions.sort(key=lambda x: (
+    suggestions = heapq.nsmallest(limit, suggestions, key=lambda x: (
         0 if x["type"] == "code" else 1 if x["type"] == "title" else 2,
         x["code"]
     ))
     
-    return {"suggestions": suggestions[:limit]}
+    return {"suggestions": suggestions}
+
+# Successful AI expansions by raw query (LRU); /autocomplete/smart asks for
+# the same partial queries over and over while users type
+EXPANSION_CACHE_SIZE = 4096
+_expansion_cache: OrderedDict[str, dict] = OrderedDict()
 
 async def expand_query_with_ai(query: str) -> dict:
     """
     Use OpenAI to expand informal Indonesian query into KBLI terminology.
     Returns expanded keywords for better search matching.
+    Successful expansions are cached, so repeated queries skip the API call.
     """
+    # A bare number is already a (partial) KBLI code: nothing to expand
+    if query.strip().isdigit():
+        return {"original": query, "expanded": query, "keywords": [query.strip()], "ai_used": False}
+    
     if not openai_client:
         return {"expanded": query, "keywords": [query], "ai_used": False}
+    
+    cached = _expansion_cache.get(query)
+    if cached is not None:
+        _expansion_cache.move_to_end(query)
+        return cached
+    
+    expansion = await _expand_query_uncached(query)
+    if expansion["ai_used"]:  # Never cache errors
+        _expansion_cache[query] = expansion
+        if len(_expansion_cache) > EXPANSION_CACHE_SIZE:
+            _expansion_cache.popitem(last=False)
+    return expansion
 
-    system_prompt = """ROLE: Anda adalah Ahli Klasifikasi Statistik BPS (Badan Pusat Statistik) khusus KBLI 2020.
+QUERY_EXPANSION_PROMPT = """ROLE: Anda adalah Ahli Klasifikasi Statistik BPS (Badan Pusat Statistik) khusus KBLI 2020.
 TUGAS: Terjemahkan query informal user menjadi KATA KUNCI TEKNIS KBLI 2020 yang presisi.
 
 PRINSIP DASAR KBLI (Metode Top-Down & Cakupan):
@@ -346,42 +563,133 @@ Input: "Jasa angkut barang pindahan rumah"
 Output: 494, angkutan jalan, pindahan
 """
 
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Input: \"{query}\""}
-            ],
-            max_tokens=60,
-            temperature=0  # Zero for strict instruction following
-        )
+# Appended to QUERY_EXPANSION_PROMPT when several queries share one request
+QUERY_EXPANSION_BATCH_PROMPT = """
+MODE BATCH: Input berupa JSON array berisi beberapa query.
+Balas JSON object {"outputs": [...]} berisi satu string Output (format di atas) per query, urutan sama dengan input."""
+
+_EXPANSION_STOP_WORDS = {"jasa", "usaha", "bisnis", "kegiatan", "aktivitas", "pelayanan", "tukang", "penjual", "pembuat", "ahli", "spesialis", "dan", "atau", "di", "ke", "dari", "yang"}
+
+def _expansion_result(query: str, expanded: str) -> dict:
+    """Turn the model's comma-separated output into an expansion dict"""
+    expanded = expanded.strip()
+    # Clean up output to get pure keywords
+    raw_keywords = [k.strip().lower() for k in expanded.split(",")]
+    # Filter empty strings and strict stop words cleanup
+    keywords = [k for k in raw_keywords if k and k not in _EXPANSION_STOP_WORDS and len(k) > 1]
+    
+    return {
+        "original": query,
+        "expanded": expanded,
+        "keywords": keywords,
+        "ai_used": True
+    }
+
+def _expand_single(query: str) -> str:
+    """One chat completion for one query (blocking; run in a thread)"""
+    response = openai_client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": QUERY_EXPANSION_PROMPT},
+            {"role": "user", "content": f"Input: \"{query}\""}
+        ],
+        max_tokens=60,
+        temperature=0  # Zero for strict instruction following
+    )
+    return response.choices[0].message.content
+
+def _expand_many(queries: list[str]) -> list[str]:
+    """
+    One chat completion for several queries (blocking; run in a thread).
+    Raises ValueError if the reply does not hold one output per query.
+    """
+    response = openai_client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": QUERY_EXPANSION_PROMPT + QUERY_EXPANSION_BATCH_PROMPT},
+            {"role": "user", "content": f"Input: {json.dumps(queries, ensure_ascii=False)}"}
+        ],
+        response_format={"type": "json_object"},
+        max_tokens=60 * len(queries),
+        temperature=0
+    )
+    outputs = json.loads(response.choices[0].message.content).get("outputs")
+    if not isinstance(outputs, list) or len(outputs) != len(queries) \
+            or not all(isinstance(o, str) for o in outputs):
+        raise ValueError("batched expansion reply does not match the inputs")
+    return outputs
+
+class QueryExpansionBatcher(MicroBatcher):
+    """
+    Micro-batches concurrent query expansions into one chat completion.
+    
+    Queries arriving within WINDOW_SECONDS of the first pending one (or
+    until MAX_BATCH are pending) are expanded together; a lone query uses
+    the regular single-query prompt. If a batched reply cannot be matched
+    back to its queries, each query falls back to its own request.
+    """
+    
+    WINDOW_SECONDS = 0.03
+    MAX_BATCH = 16
+    
+    async def expand(self, query: str) -> dict:
+        """Expansion dict for query, batched with other concurrent callers"""
+        return await self._submit(query)
+    
+    async def _flush(self, batch: list[tuple[str, asyncio.Future]]):
+        queries = list(dict.fromkeys(query for query, _ in batch))
+        results = {}
         
-        expanded = response.choices[0].message.content.strip()
-        # Clean up output to get pure keywords
-        raw_keywords = [k.strip().lower() for k in expanded.split(",")]
-        # Filter empty strings and strict stop words cleanup
-        stop_words = {"jasa", "usaha", "bisnis", "kegiatan", "aktivitas", "pelayanan", "tukang", "penjual", "pembuat", "ahli", "spesialis", "dan", "atau", "di", "ke", "dari", "yang"}
-        keywords = [k for k in raw_keywords if k and k not in stop_words and len(k) > 1]
+        if len(queries) > 1:
+            try:
+                outputs = await asyncio.to_thread(_expand_many, queries)
+                results = {q: _expansion_result(q, out) for q, out in zip(queries, outputs)}
+            except Exception as e:
+                print(f"Batched query expansion failed, expanding one by one: {e}")
         
-        return {
-            "original": query,
-            "expanded": expanded,
-            "keywords": keywords,
-            "ai_used": True
-        }
-    except Exception as e:
-        print(f"OpenAI error: {e}")
-        return {"expanded": query, "keywords": [query], "ai_used": False, "error": str(e)}
+        async def expand_one(query: str):
+            try:
+                results[query] = _expansion_result(query, await asyncio.to_thread(_expand_single, query))
+            except Exception as e:
+                print(f"OpenAI error: {e}")
+                results[query] = {"expanded": query, "keywords": [query], "ai_used": False, "error": str(e)}
+        
+        await asyncio.gather(*(expand_one(q) for q in queries if q not in results))
+        for query, future in batch:
+            if not future.done():
+                future.set_result(results[query])
+
+expansion_batcher = QueryExpansionBatcher()
+
+async def _expand_query_uncached(query: str) -> dict:
+    """OpenAI query expansion, without the cache"""
+    return await expansion_batcher.expand(query)
 
 def search_with_keywords(keywords: list[str], limit: int = 10) -> list[dict]:
     """Search KBLI using multiple keywords with advanced scoring"""
-    results = []
+    scored = []  # (score, position, matched keywords) of every match
     
-    for code, info in kbli_lookup.items():
-        judul_lower = info['judul'].lower()
-        hierarki_lower = info['hierarki'].lower()
-        cakupan_lower = info.get('cakupan', '').lower()
+    # Only entries matched by some keyword (or by the full phrase) can score
+    candidates = set()
+    full_scan = False
+    for keyword in keywords:
+        kw = keyword.lower().strip()
+        if not kw:
+            continue
+        if kw.isdigit():
+            candidates.update(kbli_code_prefixes.get(kw, ()))
+        else:
+            candidates |= _phrase_candidates(kw)
+    phrase_hits = _phrase_candidates(" ".join(keywords).lower())
+    if phrase_hits is None:
+        full_scan = True  # A blank phrase matches every title
+    else:
+        candidates |= phrase_hits
+    positions = range(len(kbli_search_keys)) if full_scan else sorted(candidates)
+    
+    for pos in positions:
+        code = kbli_search_keys[pos]
+        judul_lower, hierarki_lower, cakupan_lower, _ = kbli_search_text[pos]
         
         score = 0
         matched_keywords = []
@@ -410,7 +718,7 @@ def search_with_keywords(keywords: list[str], limit: int = 10) -> list[dict]:
             if kw in judul_lower:
                 # Check if it's a word boundary match (not substring)
                 # Simple boundary check by splitting
-                words_in_title = judul_lower.replace(",", "").replace(".", "").split()
+                words_in_title = kbli_title_words[pos]
                 if kw in words_in_title:
                     score += 1500  # Huge score for exact word match
                     keyword_found = True
@@ -442,18 +750,22 @@ def search_with_keywords(keywords: list[str], limit: int = 10) -> list[dict]:
             score += 2000  # Huge bonus for exact phrase
         
         if score > 0:
-            results.append({
-                "code": code,
-                "judul": info["judul"],
-                "hierarki": info["hierarki"],
-                "cakupan": info.get("cakupan", "")[:200],
-                "score": score,
-                "matched_keywords": list(set(matched_keywords))  # Remove duplicates
-            })
+            scored.append((score, pos, matched_keywords))
     
-    # Sort by score descending
-    results.sort(key=lambda x: x["score"], reverse=True)
-    return results[:limit]
+    # Top `limit` by score descending (nlargest keeps scan order for ties)
+    results = []
+    for score, pos, matched_keywords in heapq.nlargest(limit, scored, key=itemgetter(0)):
+        code = kbli_search_keys[pos]
+        info = kbli_lookup[code]
+        results.append({
+            "code": code,
+            "judul": info.judul,
+            "hierarki": info.hierarki,
+            "cakupan": info.cakupan[:200],
+            "score": score,
+            "matched_keywords": list(set(matched_keywords))  # Remove duplicates
+        })
+    return results
 
 @app.get("/search/smart")
 async def smart_search(q: str, limit: int = 10):
@@ -636,6 +948,96 @@ async def lookup_code_get(code: str):
         "cakupan": result["cakupan"]
     }
 
+# Parts of an .xlsx the calamine -> xlsxwriter fast path cannot carry over
+_XLSX_SHEET_TAG = re.compile(rb"<(?:\w+:)?sheet\s")
+_XLSX_FORMULA_TAG = re.compile(rb"<(?:\w+:)?f[\s>/]")
+
+def _needs_openpyxl(content: bytes) -> bool:
+    """
+    True for .xlsx workbooks that only round-trip through openpyxl: more
+    than one sheet (the others, and which one is active, would be lost) or
+    any formula (calamine only sees cached values, which files written by
+    openpyxl/pandas do not have). .xls files are never openpyxl's.
+    """
+    try:
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            if len(_XLSX_SHEET_TAG.findall(archive.read("xl/workbook.xml"))) != 1:
+                return True
+            return any(
+                _XLSX_FORMULA_TAG.search(archive.read(name))
+                for name in archive.namelist()
+                if name.startswith("xl/worksheets/") and name.endswith(".xml")
+            )
+    except (zipfile.BadZipFile, KeyError):
+        return False
+
+def _load_input_sheet(content: bytes) -> tuple[str, list, Optional["openpyxl.Workbook"]]:
+    """
+    (sheet name, raw rows, openpyxl workbook or None) of an uploaded file.
+    Plain single-sheet files are parsed by calamine (Rust); workbooks that
+    _needs_openpyxl() are loaded by openpyxl and its active sheet is used.
+    """
+    if _needs_openpyxl(content):
+        wb = openpyxl.load_workbook(BytesIO(content))
+        sheet = wb.active
+        return sheet.title, list(sheet.iter_rows(values_only=True)), wb
+    
+    workbook = python_calamine.CalamineWorkbook.from_filelike(BytesIO(content))
+    sheet = workbook.get_sheet_by_index(0)
+    return sheet.name, sheet.to_python(skip_empty_area=False), None
+
+def _load_preview_rows(content: bytes) -> tuple[list, int]:
+    """Header row + first 5 data rows (raw values) and the data row count"""
+    if _needs_openpyxl(content):
+        wb = openpyxl.load_workbook(BytesIO(content), read_only=True)
+        try:
+            sheet = wb.active
+            rows = list(sheet.iter_rows(max_row=6, values_only=True))
+            total_rows = sum(1 for _ in sheet.iter_rows(min_row=2, values_only=True))
+        finally:
+            wb.close()
+        return rows, total_rows
+    
+    workbook = python_calamine.CalamineWorkbook.from_filelike(BytesIO(content))
+    sheet = workbook.get_sheet_by_index(0)
+    # The row count comes from the sheet dimensions instead of a second pass
+    rows = sheet.to_python(skip_empty_area=False, nrows=6)
+    return rows, max(_sheet_row_count(sheet) - 1, 0)
+
+def _sheet_row_count(sheet) -> int:
+    """Rows from A1 through the last used row (openpyxl's max_row)"""
+    return sheet.end[0] + 1 if sheet.end is not None else 0
+
+def _row_values(row) -> list:
+    """
+    Normalize calamine cell values to what openpyxl reports: empty cells
+    are None, integral numbers are int (47111, not 47111.0) and dates are
+    datetime.
+    """
+    return [
+        None if value == "" else
+        int(value) if isinstance(value, float) and value.is_integer() else
+        datetime.datetime(value.year, value.month, value.day) if type(value) is datetime.date else
+        value
+        for value in row
+    ]
+
+def _write_cell(worksheet, row: int, col: int, value, cell_format=None):
+    """Write a passthrough value with xlsxwriter, keeping its type"""
+    if value is None:
+        return
+    if isinstance(value, str):
+        # Never write_formula an input string that happens to start with "="
+        worksheet.write_string(row, col, value, cell_format)
+    elif isinstance(value, bool):
+        worksheet.write_boolean(row, col, value, cell_format)
+    elif isinstance(value, (int, float)):
+        worksheet.write_number(row, col, value, cell_format)
+    elif isinstance(value, (datetime.date, datetime.time, datetime.timedelta)):
+        worksheet.write_datetime(row, col, value, cell_format)
+    else:
+        worksheet.write_string(row, col, str(value), cell_format)
+
 @app.post("/upload-preview")
 async def upload_preview(file: UploadFile = File(...)):
     """
@@ -646,25 +1048,16 @@ async def upload_preview(file: UploadFile = File(...)):
         raise HTTPException(status_code=400, detail="Only Excel files supported (.xlsx, .xls)")
     
     content = await file.read()
-    wb = openpyxl.load_workbook(BytesIO(content), read_only=True)
-    sheet = wb.active
+    raw_rows, total_rows = _load_preview_rows(content)
+    rows = [_row_values(row) for row in raw_rows]
     
     # Get headers (first row)
     headers = []
-    for cell in next(sheet.iter_rows(min_row=1, max_row=1)):
-        headers.append(cell.value or f"Column_{len(headers)+1}")
+    for value in (rows[0] if rows else []):
+        headers.append(value or f"Column_{len(headers)+1}")
     
     # Get sample data (first 5 rows)
-    sample_rows = []
-    for i, row in enumerate(sheet.iter_rows(min_row=2, max_row=6, values_only=True)):
-        sample_rows.append(list(row))
-    
-    # Count total rows
-    total_rows = 0
-    for _ in sheet.iter_rows(min_row=2, values_only=True):
-        total_rows += 1
-    
-    wb.close()
+    sample_rows = rows[1:6]
     
     return {
         "filename": file.filename,
@@ -673,59 +1066,158 @@ async def upload_preview(file: UploadFile = File(...)):
         "total_rows": total_rows
     }
 
-@app.post("/lookup/batch")
-async def lookup_batch(
-    file: UploadFile = File(...),
-    column_name: str = Form(...)
-):
+# Result cell styles (xlsxwriter format specs; the openpyxl output converts
+# them). xlsxwriter formats belong to one workbook, so each run registers
+# these once instead of styling per cell
+HEADER_FORMAT = {'bold': True, 'font_color': '#FFFFFF', 'bg_color': '#4F46E5'}
+WRAP_FORMAT = {'text_wrap': True}
+FOUND_FORMAT = {'font_color': '#22C55E'}
+NOT_FOUND_FORMAT = {'font_color': '#EF4444'}
+NO_CODE_FORMAT = {'font_color': '#F59E0B'}
+EMPTY_FORMAT = {'font_color': '#94A3B8'}
+RESULT_FORMATS = {
+    "header": HEADER_FORMAT,
+    "wrap": WRAP_FORMAT,
+    "found": FOUND_FORMAT,
+    "not_found": NOT_FOUND_FORMAT,
+    "no_code": NO_CODE_FORMAT,
+    "empty": EMPTY_FORMAT,
+}
+RESULT_COLUMN_WIDTH = 40
+
+class _XlsxwriterOutput:
     """
-    Process entire Excel file and return new Excel with lookup results.
-    Pattern matching - fast and scalable.
-    Returns Excel file directly.
+    Results streamed into a fresh workbook (constant_memory): input values
+    are copied through, original styling is not kept. With styled=True the
+    RESULT_FORMATS and column widths are applied.
     """
-    if not file.filename.endswith(('.xlsx', '.xls')):
-        raise HTTPException(status_code=400, detail="Only Excel files supported")
     
-    content = await file.read()
-    wb = openpyxl.load_workbook(BytesIO(content))
-    sheet = wb.active
+    def __init__(self, target, sheet_name: str, styled: bool):
+        self.workbook = xlsxwriter.Workbook(target, {
+            'constant_memory': True,
+            'default_date_format': 'yyyy-mm-dd'
+        })
+        self.worksheet = self.workbook.add_worksheet(sheet_name)
+        self.styled = styled
+        self.formats = {
+            kind: self.workbook.add_format(spec) if styled else None
+            for kind, spec in RESULT_FORMATS.items()
+        }
+    
+    def write_header(self, headers: list, titles: tuple[str, ...]):
+        first = len(headers)
+        if self.styled:
+            self.worksheet.set_column(first, first + len(titles) - 1, RESULT_COLUMN_WIDTH)
+        for col, value in enumerate(headers):
+            _write_cell(self.worksheet, 0, col, value)
+        for offset, title in enumerate(titles):
+            self.worksheet.write_string(0, first + offset, title, self.formats["header"])
+    
+    def write_row(self, row_idx: int, row: list, cells: list[tuple[int, str, Optional[str]]]):
+        """Copy row (0-indexed) and write its (col, text, style) result cells"""
+        for col, value in enumerate(row):
+            _write_cell(self.worksheet, row_idx, col, value)
+        for col, text, kind in cells:
+            self.worksheet.write_string(row_idx, col, text, self.formats.get(kind))
+    
+    def close(self):
+        self.workbook.close()
+
+def _openpyxl_style(spec: dict) -> dict:
+    """openpyxl cell attributes equivalent to an xlsxwriter format spec"""
+    style = {}
+    if 'font_color' in spec or 'bold' in spec:
+        style['font'] = Font(color=spec.get('font_color', '#000000').lstrip('#'), bold=spec.get('bold', False))
+    if 'bg_color' in spec:
+        color = spec['bg_color'].lstrip('#')
+        style['fill'] = PatternFill(start_color=color, end_color=color, fill_type="solid")
+    if spec.get('text_wrap'):
+        style['alignment'] = Alignment(wrap_text=True)
+    return style
+
+class _OpenpyxlOutput:
+    """
+    Results written into the uploaded workbook's active sheet, which is
+    then saved whole: other sheets, styles and formulas are kept.
+    """
+    
+    def __init__(self, wb, target, styled: bool):
+        self.wb = wb
+        self.sheet = wb.active
+        self.target = target
+        self.styled = styled
+        self.styles = {
+            kind: _openpyxl_style(spec) if styled else {}
+            for kind, spec in RESULT_FORMATS.items()
+        }
+    
+    def _write(self, row_idx: int, col: int, text: str, kind: Optional[str]):
+        cell = self.sheet.cell(row=row_idx + 1, column=col + 1, value=text)
+        for attr, value in self.styles.get(kind, {}).items():
+            setattr(cell, attr, value)
+    
+    def write_header(self, headers: list, titles: tuple[str, ...]):
+        first = len(headers)
+        for offset, title in enumerate(titles):
+            self._write(0, first + offset, title, "header")
+            if self.styled:
+                letter = openpyxl.utils.get_column_letter(first + offset + 1)
+                self.sheet.column_dimensions[letter].width = RESULT_COLUMN_WIDTH
+    
+    def write_row(self, row_idx: int, row: list, cells: list[tuple[int, str, Optional[str]]]):
+        """Write the (col, text, style) result cells of row (0-indexed); input cells stay as loaded"""
+        for col, text, kind in cells:
+            self._write(row_idx, col, text, kind)
+    
+    def close(self):
+        self.wb.save(self.target)
+        self.wb.close()
+
+def _open_output(wb, target, sheet_name: str, styled: bool):
+    """Result writer: in place for openpyxl-loaded workbooks, else a new xlsxwriter file"""
+    if wb is not None:
+        return _OpenpyxlOutput(wb, target, styled)
+    return _XlsxwriterOutput(target, sheet_name, styled)
+
+RESULT_TITLES = ("KBLI_Judul", "KBLI_Hierarki", "Lookup_Status")
+
+def _process_batch(content: bytes, column_name: str) -> tuple[BytesIO, int, int, int]:
+    """
+    /lookup/batch worker (CPU-bound, run in a thread).
+    Returns (result xlsx, total_rows, found_count, not_found_count).
+    """
+    sheet_name, rows, wb = _load_input_sheet(content)
     
     # Find column index
-    headers = [cell.value for cell in next(sheet.iter_rows(min_row=1, max_row=1))]
+    headers = _row_values(rows[0]) if rows else []
     try:
-        col_idx = headers.index(column_name) + 1  # 1-indexed for openpyxl
+        col_idx = headers.index(column_name)  # 0-indexed
     except ValueError:
         raise HTTPException(
             status_code=400,
             detail=f"Column '{column_name}' not found. Available: {headers}"
         )
     
+    output = BytesIO()
+    out = _open_output(wb, output, sheet_name, styled=True)
+    
     # Add result columns
-    result_col_judul = len(headers) + 1
-    result_col_hierarki = len(headers) + 2
-    result_col_status = len(headers) + 3
+    result_col_judul = len(headers)
+    result_col_hierarki = len(headers) + 1
+    result_col_status = len(headers) + 2
     
     # Set headers for new columns
-    sheet.cell(row=1, column=result_col_judul, value="KBLI_Judul")
-    sheet.cell(row=1, column=result_col_hierarki, value="KBLI_Hierarki")
-    sheet.cell(row=1, column=result_col_status, value="Lookup_Status")
-    
-    # Style headers
-    header_fill = PatternFill(start_color="4F46E5", end_color="4F46E5", fill_type="solid")
-    header_font = Font(color="FFFFFF", bold=True)
-    for col in [result_col_judul, result_col_hierarki, result_col_status]:
-        cell = sheet.cell(row=1, column=col)
-        cell.fill = header_fill
-        cell.font = header_font
+    out.write_header(headers, RESULT_TITLES)
     
     # Process each row
     found_count = 0
     not_found_count = 0
     total_rows = 0
     
-    for row_idx, row in enumerate(sheet.iter_rows(min_row=2, max_row=sheet.max_row), start=2):
+    for row_idx in range(1, len(rows)):
         total_rows += 1
-        cell_value = row[col_idx - 1].value
+        row = _row_values(rows[row_idx])
+        cell_value = row[col_idx]
         
         if cell_value:
             # Extract KBLI codes from cell
@@ -738,51 +1230,59 @@ async def lookup_batch(
                 found_any = False
                 
                 for code in codes:
-                    result = lookup_code(code)
-                    if result["status"] == "found":
-                        juduls.append(f"[{code}] {result['judul']}")
-                        hierarkis.append(f"[{code}] {result['hierarki']}")
+                    # Only judul/hierarki are needed, so skip building lookup_code's dict
+                    info = _lookup_code_cached(code)
+                    if info is not None:
+                        juduls.append(f"[{code}] {info.judul}")
+                        hierarkis.append(f"[{code}] {info.hierarki}")
                         found_any = True
                     else:
                         juduls.append(f"[{code}] Not Found")
                         hierarkis.append(f"[{code}] -")
                 
-                # Join with newlines
-                sheet.cell(row=row_idx, column=result_col_judul, value="\n".join(juduls))
-                sheet.cell(row=row_idx, column=result_col_hierarki, value="\n".join(hierarkis))
-                
-                # Enable wrap text for multiline
-                sheet.cell(row=row_idx, column=result_col_judul).alignment = Alignment(wrap_text=True)
-                sheet.cell(row=row_idx, column=result_col_hierarki).alignment = Alignment(wrap_text=True)
+                # Join with newlines, wrap text for multiline
+                cells = [
+                    (result_col_judul, "\n".join(juduls), "wrap"),
+                    (result_col_hierarki, "\n".join(hierarkis), "wrap"),
+                ]
                 
                 if found_any:
-                    status_text = f"Found ({len(juduls)})"
-                    sheet.cell(row=row_idx, column=result_col_status, value=status_text)
-                    sheet.cell(row=row_idx, column=result_col_status).font = Font(color="22C55E")
+                    cells.append((result_col_status, f"Found ({len(juduls)})", "found"))
                     found_count += 1
                 else:
-                    sheet.cell(row=row_idx, column=result_col_status, value="✗ Not Found")
-                    sheet.cell(row=row_idx, column=result_col_status).font = Font(color="EF4444")
+                    cells.append((result_col_status, "✗ Not Found", "not_found"))
                     not_found_count += 1
             else:
-                sheet.cell(row=row_idx, column=result_col_judul, value="")
-                sheet.cell(row=row_idx, column=result_col_hierarki, value="")
-                sheet.cell(row=row_idx, column=result_col_status, value="No code detected")
-                sheet.cell(row=row_idx, column=result_col_status).font = Font(color="F59E0B")
+                cells = [(result_col_status, "No code detected", "no_code")]
                 not_found_count += 1
         else:
-            sheet.cell(row=row_idx, column=result_col_status, value="Empty cell")
-            sheet.cell(row=row_idx, column=result_col_status).font = Font(color="94A3B8")
-    
-    # Auto-adjust column widths
-    for col in [result_col_judul, result_col_hierarki, result_col_status]:
-        sheet.column_dimensions[openpyxl.utils.get_column_letter(col)].width = 40
+            cells = [(result_col_status, "Empty cell", "empty")]
+        
+        out.write_row(row_idx, row, cells)
     
-    # Save to BytesIO
-    output = BytesIO()
-    wb.save(output)
+    out.close()
     output.seek(0)
-    wb.close()
+    
+    return output, total_rows, found_count, not_found_count
+
+@app.post("/lookup/batch")
+async def lookup_batch(
+    file: UploadFile = File(...),
+    column_name: str = Form(...)
+):
+    """
+    Process entire Excel file and return new Excel with lookup results.
+    Pattern matching - fast and scalable.
+    Returns Excel file directly.
+    """
+    if not file.filename.endswith(('.xlsx', '.xls')):
+        raise HTTPException(status_code=400, detail="Only Excel files supported")
+    
+    content = await file.read()
+    # Keep the event loop free for other requests while the sheet is processed
+    output, total_rows, found_count, not_found_count = await asyncio.to_thread(
+        _process_batch, content, column_name
+    )
     
     # Generate filename
     original_name = Path(file.filename).stem
@@ -817,6 +1317,80 @@ async def download_file(filename: str):
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
 
+STREAM_CHUNK_ROWS = 500  # Rows per worker-thread hop in /lookup/batch-stream
+PROGRESS_EVERY_ROWS = 50  # Send a progress event at least every N rows...
+PROGRESS_EVERY_SECONDS = 0.25  # ...or once this much time has passed
+
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+def _sse_event(payload: dict) -> bytes:
+    """One server-sent event carrying payload as JSON"""
+    body = orjson.dumps(payload) if orjson is not None else json.dumps(payload).encode()
+    return SSE_PREFIX + body + SSE_SUFFIX
+
+def _process_stream_rows(rows: list, out, first_row: int, last_row: int,
+                         col_idx: int, result_cols: tuple[int, int, int],
+                         total_rows: int, progress: dict) -> list[bytes]:
+    """
+    /lookup/batch-stream worker: write rows[first_row:last_row] (0-indexed,
+    header is row 0) with their result columns to the output, updating the
+    progress counters in place. Returns the SSE progress events for those
+    rows, throttled to PROGRESS_EVERY_ROWS / PROGRESS_EVERY_SECONDS.
+    """
+    result_col_judul, result_col_hierarki, result_col_status = result_cols
+    events = []
+    
+    for row_idx in range(first_row, last_row):
+        row = _row_values(rows[row_idx])
+        cell_value = row[col_idx]
+        current = row_idx
+        result_info = {"code": "", "judul": "", "status": "empty"}
+        
+        if cell_value:
+            codes = extract_kbli_codes(str(cell_value))
+            if codes:
+                # Lookup logic (simplified for brevity in this replace block, but actual logic remains)
+                juduls = []
+                valid_codes = []
+                found_any = False
+                
+                for code in codes:
+                    info = _lookup_code_cached(code)
+                    if info is not None:
+                        found_any = True
+                        valid_codes.append(info.kode)
+                        juduls.append(f"[{info.kode}] {info.judul}")
+                
+                if found_any:
+                    cells = [(result_col_judul, "; ".join(juduls), None)]
+                    # Hierarki of the last code in the cell (empty if it was not found)
+                    if info is not None and info.hierarki:
+                        cells.append((result_col_hierarki, info.hierarki, None))
+                    cells.append((result_col_status, "Found", None))
+                    progress["found"] += 1
+                    result_info = {"code": valid_codes[0], "judul": juduls[0], "status": "found"}
+                else:
+                    cells = [(result_col_status, "Not Found", None)]
+                    progress["not_found"] += 1
+                    result_info = {"code": f"{len(codes)} codes", "judul": "", "status": "not_found"}
+            else:
+                cells = [(result_col_status, "No Code", None)]
+        else:
+            cells = [(result_col_status, "Empty", None)]
+        
+        out.write_row(row_idx, row, cells)
+
+        # Send progress; only the final event carries the latest row
+        if current == total_rows:
+            events.append(_sse_event({'type': 'progress', 'current': current, 'total': total_rows, 'found': progress['found'], 'not_found': progress['not_found'], 'latest': result_info}))
+        elif current - progress["last_row"] >= PROGRESS_EVERY_ROWS \
+                or time.monotonic() - progress["last_time"] >= PROGRESS_EVERY_SECONDS:
+            events.append(_sse_event({'type': 'progress', 'current': current, 'total': total_rows, 'found': progress['found'], 'not_found': progress['not_found']}))
+            progress["last_row"], progress["last_time"] = current, time.monotonic()
+    
+    return events
+
 @app.post("/lookup/batch-stream")
 async def lookup_batch_stream(
     file: UploadFile = File(...),
@@ -835,84 +1409,54 @@ async def lookup_batch_stream(
     original_filename = file.filename
 
     async def generate():
-        wb = openpyxl.load_workbook(BytesIO(content))
-        sheet = wb.active
+        sheet_name, rows, wb = await asyncio.to_thread(_load_input_sheet, content)
         
         # Find column index
-        headers = [cell.value for cell in next(sheet.iter_rows(min_row=1, max_row=1))]
+        headers = _row_values(rows[0]) if rows else []
         try:
-            col_idx = headers.index(column_name) + 1
+            col_idx = headers.index(column_name)  # 0-indexed
         except ValueError:
-            yield f"data: {json.dumps({'type': 'error', 'message': f'Column not found: {column_name}'})}\n\n"
+            yield _sse_event({'type': 'error', 'message': f'Column not found: {column_name}'})
             return
         
         # Count total rows first
-        total_rows = sheet.max_row - 1
-        yield f"data: {json.dumps({'type': 'start', 'total': total_rows})}\n\n"
-        
-        # Add result columns (same logic as before...)
-        result_col_judul = len(headers) + 1
-        result_col_hierarki = len(headers) + 2
-        result_col_status = len(headers) + 3
-        
-        sheet.cell(row=1, column=result_col_judul, value="KBLI_Judul")
-        sheet.cell(row=1, column=result_col_hierarki, value="KBLI_Hierarki")
-        sheet.cell(row=1, column=result_col_status, value="Lookup_Status")
+        total_rows = len(rows) - 1
+        yield _sse_event({'type': 'start', 'total': total_rows})
         
-        found_count = 0
-        not_found_count = 0
-        
-        for row_idx, row in enumerate(sheet.iter_rows(min_row=2, max_row=sheet.max_row), start=2):
-            cell_value = row[col_idx - 1].value
-            current = row_idx - 1
-            result_info = {"code": "", "judul": "", "status": "empty"}
-            
-            if cell_value:
-                codes = extract_kbli_codes(str(cell_value))
-                if codes:
-                    # Lookup logic (simplified for brevity in this replace block, but actual logic remains)
-                    juduls = []
-                    valid_codes = []
-                    found_any = False
-                    
-                    for code in codes:
-                        res = lookup_code(code)
-                        if res["status"] == "found":
-                            found_any = True
-                            valid_codes.append(res["kode"])
-                            juduls.append(f"[{res['kode']}] {res['judul']}")
-                    
-                    if found_any:
-                        sheet.cell(row=row_idx, column=result_col_judul, value="; ".join(juduls))
-                        sheet.cell(row=row_idx, column=result_col_hierarki, value=res.get("hierarki", ""))
-                        sheet.cell(row=row_idx, column=result_col_status, value="Found")
-                        found_count += 1
-                        result_info = {"code": valid_codes[0], "judul": juduls[0], "status": "found"}
-                    else:
-                        sheet.cell(row=row_idx, column=result_col_status, value="Not Found")
-                        not_found_count += 1
-                        result_info = {"code": f"{len(codes)} codes", "judul": "", "status": "not_found"}
-                else:
-                     sheet.cell(row=row_idx, column=result_col_status, value="No Code")
-            else:
-                 sheet.cell(row=row_idx, column=result_col_status, value="Empty")
-
-            # Send progress
-            if current % 10 == 0 or current == total_rows:
-                yield f"data: {json.dumps({'type': 'progress', 'current': current, 'total': total_rows, 'found': found_count, 'not_found': not_found_count, 'latest': result_info})}\n\n"
-        
-        # Save to TEMP file instead of returning base64
+        # Results go to the TEMP file (xlsxwriter streams it, constant_memory;
+        # openpyxl-loaded workbooks are saved whole at the end)
         original_name_stem = Path(original_filename).stem
         result_filename = f"{original_name_stem}_RESULT.xlsx"
         save_path = TEMP_DIR / result_filename
+        out = _open_output(wb, str(save_path), sheet_name, styled=False)
+        
+        # Add result columns (same logic as before...)
+        result_col_judul = len(headers)
+        result_col_hierarki = len(headers) + 1
+        result_col_status = len(headers) + 2
+        result_cols = (result_col_judul, result_col_hierarki, result_col_status)
+        
+        out.write_header(headers, RESULT_TITLES)
+        
+        # Rows are processed in a worker thread STREAM_CHUNK_ROWS at a time;
+        # the chunk's progress events are sent before the next one starts
+        progress = {"found": 0, "not_found": 0, "last_row": 0, "last_time": time.monotonic()}
+        for chunk_start in range(1, len(rows), STREAM_CHUNK_ROWS):
+            chunk_end = min(chunk_start + STREAM_CHUNK_ROWS, len(rows))
+            events = await asyncio.to_thread(
+                _process_stream_rows, rows, out, chunk_start, chunk_end,
+                col_idx, result_cols, total_rows, progress
+            )
+            for event in events:
+                yield event
+        found_count, not_found_count = progress["found"], progress["not_found"]
         
-        wb.save(save_path)
-        wb.close()
+        await asyncio.to_thread(out.close)
         
         # Return download URL instead of file content
         download_url = f"/download/{result_filename}"
         
-        yield f"data: {json.dumps({'type': 'complete', 'total': total_rows, 'found': found_count, 'not_found': not_found_count, 'download_url': download_url})}\n\n"
+        yield _sse_event({'type': 'complete', 'total': total_rows, 'found': found_count, 'not_found': not_found_count, 'download_url': download_url})
 
     return StreamingResponse(
         generate(),
@@ -3,84 +3,232 @@ RAG Service for KBLI Classification
 Implements: Intent Splitting -> Parallel Search -> Classification
 """
 import asyncio
+import copy
 import json
-import re
+from functools import lru_cache
+from collections import OrderedDict
+from pathlib import Path
 from typing import Optional
+import numpy as np
 from openai import AsyncOpenAI
 
+try:
+    import orjson
+except ImportError:  # Optional: LLM output parsed with stdlib json
+    orjson = None
+
+try:
+    import tiktoken
+except ImportError:  # Optional: context tokens estimated from character count
+    tiktoken = None
+
+try:
+    from backend.hybrid_search import BM25, LocalVectorStore
+except ImportError:
+    from hybrid_search import BM25, LocalVectorStore
+
+# Static prompts live at module level so every request starts with the same
+# byte-identical prefix (eligible for OpenAI prompt caching); only the user
+# message varies
+SPLIT_INTENTS_PROMPT = """Pecah deskripsi kegiatan usaha berikut menjadi kegiatan usaha terpisah.
+Jika hanya ada 1 kegiatan, kembalikan hanya 1 item.
+Output HANYA JSON array of strings, tanpa penjelasan.
+
+Contoh output: ["Jual pulsa", "Jual nasi goreng"]"""
+
+CLASSIFY_SYSTEM_PROMPT = """You are an expert KBLI classifier for BPS Statistics Indonesia.
+Your task is to classify the user's business activity description into one OR MORE KBLI 2020 codes based STRICTLY on the provided context.
+
+Rules:
+1. Analyze if the description contains multiple distinct business activities.
+2. If multiple activities exist, output a list of classifications.
+3. Assign a confidence score (0.0 - 1.0) for EACH code independently.
+4. Explain your reasoning briefly referencing the "Cakupan".
+5. If the context does not contain a suitable match, output "UNMAPPED".
+
+Response Format (JSON ONLY, no markdown):
+{
+  "classifications": [
+    {
+      "code": "47414",
+      "title": "Perdagangan Eceran...",
+      "confidence": 0.96,
+      "reasoning": "..."
+    }
+  ]
+}"""
+
+def _json_loads(data: str | bytes):
+    """Parse JSON (str or UTF-8 bytes) with orjson when installed"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+# classify() codes that stand for "no KBLI code" rather than a real match
+PLACEHOLDER_CODES = ("UNMAPPED", "ERROR")
+
+CONTEXT_SEPARATOR = "\n---\n"
+CHARS_PER_TOKEN = 4  # Rough estimate used when tiktoken is unavailable
+
+@lru_cache(maxsize=1)
+def _token_encoding():
+    """tiktoken encoding of the classify model, or None if it cannot be loaded"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model("gpt-4o-mini")
+    except Exception:  # BPE file not cached and no network
+        return None
+
+def _count_tokens(text: str) -> int:
+    encoding = _token_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+def _truncate_tokens(text: str, max_tokens: int) -> str:
+    encoding = _token_encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    return encoding.decode(encoding.encode(text)[:max_tokens])
+
 # For now, we'll use a mock vector store (in-memory) for sampling
 # Real implementation would use Supabase
 
 class RAGService:
+    # Semantic result cache: process() reuses a previous result when the
+    # input embedding's cosine similarity to a cached one reaches the threshold
+    SEMANTIC_CACHE_THRESHOLD = 0.95
+    SEMANTIC_CACHE_SIZE = 1000  # Ring buffer; the oldest entry is replaced
+    
+    # Inputs shorter than this skip split_intents: classify() already
+    # separates multiple activities, so one retrieval on the full text and a
+    # single LLM call are enough
+    SPLIT_MIN_WORDS = 12
+    MAX_CONTEXT_CHUNKS = 10
+    
+    # classify() packs context chunks in score order up to this many tokens;
+    # only the chunk that crosses the budget has its cakupan trimmed, and it
+    # is dropped instead if less than MIN_CAKUPAN_TOKENS would remain
+    CONTEXT_TOKEN_BUDGET = 2500
+    MIN_CAKUPAN_TOKENS = 32
+    
+    # Successful split_intents results by normalized text (LRU)
+    INTENT_CACHE_SIZE = 10_000
+    
     def __init__(self, openai_client: AsyncOpenAI, kbli_data: list[dict]):
         self.client = openai_client
         self.kbli_data = kbli_data  # In-memory for sampling
         self._embeddings_cache = {}
+        
+        # Only 5-digit codes are classifiable (skips intro pages etc.)
+        self.valid_entries = [
+            e for e in kbli_data
+            if e.get("kode_kbli", "").isdigit() and len(e.get("kode_kbli", "")) == 5
+        ]
+        # BM25 index over judul + content, built once
+        self.bm25 = BM25()
+        self.bm25.fit_from_texts(
+            [f"{e.get('judul', '')} {e.get('content', '')}" for e in self.valid_entries],
+            self.valid_entries
+        )
+        
+        # Embedding index, used by retrieve() once build_embeddings() ran
+        self.vector_store = LocalVectorStore(openai_client)
+        
+        # Normalized input embeddings (one row per cached result)
+        self._sem_embeddings = np.zeros(
+            (self.SEMANTIC_CACHE_SIZE, LocalVectorStore.EMBEDDING_DIM), dtype=np.float32
+        )
+        self._sem_results: list[dict] = []
+        self._sem_next = 0  # Row to write next once the buffer is full
+        
+        self._intent_cache: OrderedDict[str, list[str]] = OrderedDict()
+    
+    async def build_embeddings(self, cache_dir: Path = None):
+        """
+        Embed all valid entries once (batched, concurrent requests) into an
+        in-process vector index. With cache_dir the embeddings are saved to
+        and reloaded from disk; the text recipe matches HybridSearchEngine,
+        so both can share one cache. The tiktoken encoding is loaded in a
+        worker thread meanwhile, so its first (blocking) load never runs on
+        the event loop during process().
+        """
+        await asyncio.gather(
+            self.vector_store.build_index_from_texts(
+                [f"{str(e.get('judul', ''))[:500]} {str(e.get('cakupan', ''))[:500]}" for e in self.valid_entries],
+                self.valid_entries,
+                cache_dir=cache_dir
+            ),
+            asyncio.to_thread(_token_encoding)
+        )
     
     async def split_intents(self, text: str) -> list[str]:
         """
         Step 1: Split multi-activity descriptions into separate intents.
         Example: "Jual pulsa dan nasi goreng" -> ["Jual pulsa", "Jual nasi goreng"]
+        Successful splits are cached, so repeated inputs skip the API call.
         """
-        prompt = f"""Pecah deskripsi kegiatan usaha berikut menjadi kegiatan usaha terpisah.
-Jika hanya ada 1 kegiatan, kembalikan hanya 1 item.
-Output HANYA JSON array of strings, tanpa penjelasan.
-
-Deskripsi: "{text}"
-
-Contoh output: ["Jual pulsa", "Jual nasi goreng"]"""
-
+        key = text.strip().lower()
+        cached = self._intent_cache.get(key)
+        if cached is not None:
+            self._intent_cache.move_to_end(key)
+            return list(cached)
+        
+        intents = await self._split_intents_uncached(text)
+        if intents is None:  # Never cache the fallback
+            return [text]
+        self._intent_cache[key] = intents
+        if len(self._intent_cache) > self.INTENT_CACHE_SIZE:
+            self._intent_cache.popitem(last=False)
+        return list(intents)
+    
+    async def _split_intents_uncached(self, text: str) -> Optional[list[str]]:
+        """LLM intent split; None unless the response holds a non-empty JSON array of strings"""
         response = await self.client.chat.completions.create(
             model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
+            messages=[
+                {"role": "system", "content": SPLIT_INTENTS_PROMPT},
+                {"role": "user", "content": f'Deskripsi: "{text}"'}
+            ],
             temperature=0,
             max_tokens=200
         )
         
         try:
             content = response.choices[0].message.content.strip()
-            # Extract JSON array from response
-            match = re.search(r'\[.*\]', content, re.DOTALL)
-            if match:
-                return json.loads(match.group())
-            return [text]  # Fallback to original
+            # Extract JSON array from response (first "[" through last "]")
+            start, end = content.find("["), content.rfind("]")
+            if start == -1 or end <= start:
+                return None
+            intents = _json_loads(content[start:end + 1])
+            if not isinstance(intents, list):
+                return None
+            intents = [intent for intent in intents if isinstance(intent, str) and intent.strip()]
+            return intents or None
         except:
-            return [text]
+            return None
     
     async def retrieve(self, query: str, top_k: int = 5) -> list[dict]:
         """
-        Step 2: Vector search (simplified keyword match for sampling).
-        Real implementation uses Supabase pgvector.
+        Step 2: Vector search over the embedding index (HNSW / SIMD scan),
+        BM25 keyword ranking until build_embeddings() has run.
         """
-        # Simplified: keyword matching for sampling mode
-        query_lower = query.lower()
-        keywords = query_lower.split()
-        
-        scored = []
-        for entry in self.kbli_data:
-            content = entry.get("content", "").lower()
-            judul = entry.get("judul", "").lower()
-            
-            # Skip invalid entries (like intro pages)
-            if not entry.get("kode_kbli", "").isdigit():
-                continue
-            if len(entry.get("kode_kbli", "")) != 5:
-                continue
-            
-            score = 0
-            for kw in keywords:
-                if len(kw) > 2:  # Skip short words
-                    if kw in judul:
-                        score += 3
-                    elif kw in content:
-                        score += 1
-            
-            if score > 0:
-                scored.append((score, entry))
-        
-        # Sort by score descending
-        scored.sort(key=lambda x: x[0], reverse=True)
-        return [entry for _, entry in scored[:top_k]]
+        if self.vector_store.is_ready:
+            hits = await self.vector_store.search(query, top_k)
+            return [self.vector_store.documents[idx] for idx, _ in hits]
+        return [self.valid_entries[idx] for idx, _ in self.bm25.search(query, top_k)]
+    
+    async def retrieve_batch(self, queries: list[str], top_k: int = 5) -> list[list[dict]]:
+        """
+        retrieve() for several queries at once. BM25 scores them in one pass
+        over the index (search_batch); vector searches run concurrently and
+        their query embeddings share coalesced requests.
+        """
+        if self.vector_store.is_ready:
+            return list(await asyncio.gather(*(self.retrieve(q, top_k) for q in queries)))
+        return [
+            [self.valid_entries[idx] for idx, _ in hits]
+            for hits in self.bm25.search_batch(queries, top_k)
+        ]
     
     async def classify(self, original_text: str, context_chunks: list[dict]) -> dict:
         """
@@ -97,34 +245,8 @@ Contoh output: ["Jual pulsa", "Jual nasi goreng"]"""
                 }]
             }
         
-        # Build context string
-        context_str = "\n---\n".join([
-            f"KODE: {c['kode_kbli']}\nJUDUL: {c['judul']}\nCAKUPAN: {c.get('cakupan', '')[:500]}"
-            for c in context_chunks
-        ])
+        context_str = self._build_context(context_chunks)
         
-        system_prompt = """You are an expert KBLI classifier for BPS Statistics Indonesia.
-Your task is to classify the user's business activity description into one OR MORE KBLI 2020 codes based STRICTLY on the provided context.
-
-Rules:
-1. Analyze if the description contains multiple distinct business activities.
-2. If multiple activities exist, output a list of classifications.
-3. Assign a confidence score (0.0 - 1.0) for EACH code independently.
-4. Explain your reasoning briefly referencing the "Cakupan".
-5. If the context does not contain a suitable match, output "UNMAPPED".
-
-Response Format (JSON ONLY, no markdown):
-{
-  "classifications": [
-    {
-      "code": "47414",
-      "title": "Perdagangan Eceran...",
-      "confidence": 0.96,
-      "reasoning": "..."
-    }
-  ]
-}"""
-
         user_prompt = f"""Deskripsi Usaha: "{original_text}"
 
 Konteks KBLI yang tersedia:
@@ -135,7 +257,7 @@ Klasifikasikan deskripsi di atas. Output JSON saja."""
         response = await self.client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": CLASSIFY_SYSTEM_PROMPT},
                 {"role": "user", "content": user_prompt}
             ],
             temperature=0,
@@ -146,10 +268,12 @@ Klasifikasikan deskripsi di atas. Output JSON saja."""
             content = response.choices[0].message.content.strip()
             # Extract JSON from response (handle markdown code blocks)
             if "```" in content:
-                match = re.search(r'```(?:json)?\s*(.*?)```', content, re.DOTALL)
-                if match:
-                    content = match.group(1).strip()
-            return json.loads(content)
+                fenced = content.partition("```")[2]
+                if "```" in fenced:
+                    fenced = fenced.partition("```")[0]
+                    content = fenced[4:] if fenced.startswith("json") else fenced
+                    content = content.strip()
+            return _json_loads(content)
         except Exception as e:
             return {
                 "classifications": [{
@@ -160,30 +284,143 @@ Klasifikasikan deskripsi di atas. Output JSON saja."""
                 }]
             }
     
+    def _build_context(self, context_chunks: list[dict]) -> str:
+        """Join context chunks (in score order) within CONTEXT_TOKEN_BUDGET"""
+        separator_tokens = _count_tokens(CONTEXT_SEPARATOR)
+        parts = []
+        used = 0
+        for c in context_chunks:
+            head = f"KODE: {c['kode_kbli']}\nJUDUL: {c['judul']}\nCAKUPAN: "
+            cakupan = c.get('cakupan', '')
+            cost = _count_tokens(head) + (separator_tokens if parts else 0)
+            remaining = self.CONTEXT_TOKEN_BUDGET - used - cost
+            cakupan_tokens = _count_tokens(cakupan)
+            if cakupan_tokens > remaining:
+                # The first chunk is always kept so the context is never empty
+                if remaining < self.MIN_CAKUPAN_TOKENS and parts:
+                    break
+                parts.append(head + _truncate_tokens(cakupan, max(remaining, self.MIN_CAKUPAN_TOKENS)))
+                break
+            parts.append(head + cakupan)
+            used += cost + cakupan_tokens
+        return CONTEXT_SEPARATOR.join(parts)
+    
+    async def _semantic_key(self, text: str) -> Optional[np.ndarray]:
+        """Normalized embedding of text for the semantic cache (None on failure)"""
+        try:
+            embedding = await self.vector_store.embed(text)
+        except Exception as e:
+            print(f"⚠️ Semantic cache skipped: {e}")
+            return None
+        return embedding / (np.linalg.norm(embedding) + 1e-10)
+    
+    def _semantic_get(self, key: np.ndarray) -> Optional[dict]:
+        """Cached result for the most similar previous input, if similar enough"""
+        if not self._sem_results:
+            return None
+        similarities = self._sem_embeddings[:len(self._sem_results)] @ key
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.SEMANTIC_CACHE_THRESHOLD:
+            return None
+        return copy.deepcopy(self._sem_results[best])
+    
+    def _semantic_put(self, key: np.ndarray, result: dict):
+        """Remember result for key, replacing the oldest entry when full"""
+        if len(self._sem_results) < self.SEMANTIC_CACHE_SIZE:
+            row = len(self._sem_results)
+            self._sem_results.append(None)
+        else:
+            row = self._sem_next
+            self._sem_next = (row + 1) % self.SEMANTIC_CACHE_SIZE
+        self._sem_embeddings[row] = key
+        self._sem_results[row] = copy.deepcopy(result)
+    
+    @staticmethod
+    def _merge_context(all_results: list[list[dict]]) -> list[dict]:
+        """Concatenate retrieval results, keeping the first entry per kode_kbli"""
+        merged = {}  # Insertion-ordered: first occurrence keeps its position
+        for results in all_results:
+            for entry in results:
+                code = entry.get("kode_kbli")
+                if code and code not in merged:
+                    merged[code] = entry
+        return list(merged.values())
+    
+    @staticmethod
+    def _merge_classifications(results: list[dict]) -> tuple[dict, bool]:
+        """
+        Combine per-intent classify() results, keeping the best confidence per code.
+        UNMAPPED/ERROR placeholders are dropped when any intent found a real
+        code; otherwise a single placeholder is returned (ERROR if any intent
+        failed). Also returns whether any intent failed, since a dropped
+        ERROR still means the merged result is incomplete.
+        """
+        best: dict[str, dict] = {}
+        placeholders: dict[str, dict] = {}
+        for result in results:
+            for cls in result.get("classifications", []):
+                code = cls.get("code")
+                target = placeholders if code in PLACEHOLDER_CODES else best
+                if code not in target or cls.get("confidence", 0) > target[code].get("confidence", 0):
+                    target[code] = cls
+        errored = "ERROR" in placeholders
+        if not best and placeholders:
+            return {"classifications": [placeholders.get("ERROR") or placeholders["UNMAPPED"]]}, errored
+        return {"classifications": list(best.values())}, errored
+    
     async def process(self, text: str) -> dict:
         """
         Full pipeline: Split -> Parallel Retrieve -> Classify
+        Semantically near-identical inputs reuse an earlier result.
         """
-        # Step 1: Split intents
-        intents = await self.split_intents(text)
+        short = len(text.split()) < self.SPLIT_MIN_WORDS
         
-        # Step 2: Parallel retrieval for each intent
-        retrieve_tasks = [self.retrieve(intent) for intent in intents]
-        all_results = await asyncio.gather(*retrieve_tasks)
+        # The cache key embedding runs alongside the first pipeline step
+        # (retrieval or intent splitting) instead of in front of it
+        sem_task = asyncio.create_task(self._semantic_key(text))
+        if short:
+            # Short input: retrieve on the full text, with the whole context
+            # budget since it may still name several activities
+            first_step = asyncio.create_task(self.retrieve(text, top_k=self.MAX_CONTEXT_CHUNKS))
+        else:
+            # Step 1: Split intents
+            first_step = asyncio.create_task(self.split_intents(text))
         
-        # Merge and deduplicate by kode_kbli
-        seen_codes = set()
-        merged_context = []
-        for results in all_results:
-            for entry in results:
-                code = entry.get("kode_kbli")
-                if code and code not in seen_codes:
-                    seen_codes.add(code)
-                    merged_context.append(entry)
+        sem_key = await sem_task
+        if sem_key is not None:
+            cached = self._semantic_get(sem_key)
+            if cached is not None:
+                first_step.cancel()
+                return cached
         
-        # Step 3: Classify
-        result = await self.classify(text, merged_context[:10])  # Limit context
+        if short:
+            intents = [text]
+            context = self._merge_context([await first_step])
+            
+            # Step 3: Classify
+            result = await self.classify(text, context)
+            errored = False
+        else:
+            intents = await first_step
+            
+            # Step 2: Batched retrieval for all intents
+            all_results = await self.retrieve_batch(intents)
+            
+            # Step 3: Classify each intent against its own (deduplicated)
+            # context concurrently: short prompts instead of one merged one
+            classify_tasks = [
+                self.classify(intent, self._merge_context([results]))
+                for intent, results in zip(intents, all_results)
+            ]
+            result, errored = self._merge_classifications(await asyncio.gather(*classify_tasks))
         result["intents_detected"] = intents
+        
+        # Parsing failures are not worth repeating for similar inputs (a
+        # merged result may have dropped a failed intent's ERROR entry)
+        if sem_key is not None and not errored and not any(
+            c.get("code") == "ERROR" for c in result.get("classifications", [])
+        ):
+            self._semantic_put(sem_key, result)
         return result
 
 
@@ -195,8 +432,7 @@ async def test_rag_service():
     
     # Load sample KBLI data
     json_path = Path(__file__).parent.parent / "kbli_parsed_fast.json"
-    with open(json_path, 'r', encoding='utf-8') as f:
-        kbli_data = json.load(f)
+    kbli_data = _json_loads(json_path.read_bytes())
     
     # Filter valid entries (5-digit codes only)
     valid_data = [
@@ -209,6 +445,7 @@ async def test_rag_service():
     # Initialize
     client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
     rag = RAGService(client, valid_data)
+    await rag.build_embeddings()
     
     # Test cases
     test_inputs = [
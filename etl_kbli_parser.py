@@ -6,12 +6,19 @@ untuk menangani deskripsi yang terpotong antar halaman.
 """
 
 import fitz  # PyMuPDF
+import os
 import re
 import json
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from dataclasses import dataclass, asdict
 import time
 
+try:
+    import orjson
+except ImportError:  # Opsional: tanpa orjson, to_json pakai json.dump
+    orjson = None
+
 # Configuration
 PDF_PATH = Path(r"c:\Users\US3R\OneDrive\Dokumen\Kerja\2026\Distribusi\SBR\kbli2020\KBLI_2020_1659511143.pdf")
 OUTPUT_PATH = Path(r"c:\Users\US3R\OneDrive\Dokumen\Kerja\2026\Distribusi\SBR\kbli2020\kbli_parsed_fast.json")
@@ -23,10 +30,31 @@ PATTERNS = {
     "golongan": re.compile(r"^(\d{3})\s+([A-ZÉÈÊ\s,]+)$"),
     "sub_golongan": re.compile(r"^(\d{4})\s+([A-ZÉÈÊ\s,]+)$"),
     "kelompok": re.compile(r"^(\d{5})\s+(.+)$"),
-    # Regex untuk mendeteksi baris yang MERUPAKAN header kode baru (untuk stop condition)
-    "any_code_start": re.compile(r"^([A-U]|\d{2}|\d{3}|\d{4}|\d{5})\s+")
 }
 
+# Prefix umum cakupan yang dibuang
+CAKUPAN_PREFIX = re.compile(r"^(Kelompok|Subgolongan|Golongan) ini mencakup\s*", re.IGNORECASE)
+
+# Header kode angka: panjang deret digit di awal baris -> pattern yang mungkin cocok
+HEADER_BY_DIGITS = {2: "golongan_pokok", 3: "golongan", 4: "sub_golongan", 5: "kelompok"}
+
+# Ekstraksi teks paralel: halaman dibagi jadi kira-kira sekian potongan per worker
+PAGE_CHUNKS_PER_WORKER = 4
+
+def _extract_page_lines(pdf_path: str, first_page: int, last_page: int) -> list[tuple[str, int]]:
+    """Worker: baris non-kosong (sudah di-strip) halaman [first_page, last_page),
+    beserta nomor halaman (mulai dari 1)."""
+    lines = []
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(first_page, last_page):
+            # Flags: sort=True penting agar urutan teks sesuai layout visual
+            text = doc[page_num].get_text("text", sort=True)
+            for line in text.split('\n'):
+                cleaned = line.strip()
+                if cleaned: # Skip empty lines
+                    lines.append((cleaned, page_num + 1))
+    return lines
+
 @dataclass
 class KBLIEntry:
     kode_kbli: str
@@ -42,13 +70,13 @@ class KBLIEntry:
     sub_golongan: str = ""
 
     def to_content_text(self) -> str:
-        # Bersihkan spasi berlebih/newline pada cakupan
-        clean_cakupan = " ".join(self.cakupan.split())
-        return f"KODE: {self.kode_kbli}\nJUDUL: {self.judul}\nHIERARKI: {self.hierarki}\nCAKUPAN: {clean_cakupan}"
+        # Cakupan sudah bersih dari spasi berlebih (lihat _finalize_entry)
+        return f"KODE: {self.kode_kbli}\nJUDUL: {self.judul}\nHIERARKI: {self.hierarki}\nCAKUPAN: {self.cakupan}"
 
 class FastKBLIParser:
-    def __init__(self, pdf_path: Path):
+    def __init__(self, pdf_path: Path, workers: int = None):
         self.pdf_path = pdf_path
+        self.workers = workers or os.cpu_count() or 1  # Proses untuk ekstraksi teks
         self.entries = []
         
         # State Hierarchy (Raw strings)
@@ -58,33 +86,60 @@ class FastKBLIParser:
         self.gol = ""
         self.sub_gol = ""
 
-    def _get_line_stream(self, doc):
+    def _get_line_stream(self, page_count: int):
         """Generator yang menggabungkan seluruh halaman jadi satu aliran teks panjang.
-        Ini solusi untuk masalah Cross-Page."""
-        for page_num, page in enumerate(doc):
-            # Flags: sort=True penting agar urutan teks sesuai layout visual
-            text = page.get_text("text", sort=True) 
-            lines = text.split('\n')
-            for line in lines:
-                cleaned = line.strip()
-                if cleaned: # Skip empty lines
-                    yield cleaned, page_num + 1
+        Ini solusi untuk masalah Cross-Page.
+        
+        Ekstraksi teks (CPU-bound) dibagi per potongan halaman ke beberapa proses;
+        hasilnya digabung lagi sesuai urutan halaman, jadi state machine di parse()
+        tetap melihat satu aliran yang sama."""
+        if self.workers <= 1:
+            yield from _extract_page_lines(str(self.pdf_path), 0, page_count)
+            return
+        
+        chunk_size = max(1, -(-page_count // (self.workers * PAGE_CHUNKS_PER_WORKER)))
+        starts = range(0, page_count, chunk_size)
+        stops = [min(start + chunk_size, page_count) for start in starts]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            # map() mengembalikan hasil sesuai urutan input (urutan halaman)
+            for lines in pool.map(_extract_page_lines, [str(self.pdf_path)] * len(starts), starts, stops):
+                yield from lines
 
     def parse(self):
         print(f"Opening PDF: {self.pdf_path}")
         start_time = time.time()
         
-        doc = fitz.open(self.pdf_path)
-        print(f"Total pages: {len(doc)}")
+        with fitz.open(self.pdf_path) as doc:
+            page_count = len(doc)
+        print(f"Total pages: {page_count}")
 
-        line_stream = self._get_line_stream(doc)
+        line_stream = self._get_line_stream(page_count)
         
         current_entry = None
         buffer_cakupan = []
         
+        # Method .match di-bind ke variabel lokal: hemat lookup dict + atribut per baris
+        match_kategori = PATTERNS["kategori"].match
+        match_golongan_pokok = PATTERNS["golongan_pokok"].match
+        match_golongan = PATTERNS["golongan"].match
+        match_sub_golongan = PATTERNS["sub_golongan"].match
+        match_kelompok = PATTERNS["kelompok"].match
+        
         for line, page_num in line_stream:
+            # 0. Dispatch dari karakter pertama: paling banyak satu pattern header
+            #    yang mungkin cocok, sisanya tidak perlu dicoba
+            first = line[0]
+            level = None
+            if "A" <= first <= "U":
+                level = "kategori"
+            elif first.isdecimal():  # \d == karakter desimal Unicode
+                digits = 1
+                while line[digits:digits + 1].isdecimal():
+                    digits += 1
+                level = HEADER_BY_DIGITS.get(digits)
+            
             # 1. Cek Pattern Hirarki (Reset state sesuai level)
-            if match := PATTERNS["kategori"].match(line):
+            if level == "kategori" and (match := match_kategori(line)):
                 self.cat_code = match.group(1)
                 self.cat_name = match.group(2)
                 self.gol_pok = self.gol = self.sub_gol = "" # Reset lower
@@ -92,28 +147,28 @@ class FastKBLIParser:
                 current_entry = None; buffer_cakupan = []
                 continue
 
-            if match := PATTERNS["golongan_pokok"].match(line):
+            if level == "golongan_pokok" and (match := match_golongan_pokok(line)):
                 self.gol_pok = f"{match.group(1)} {match.group(2)}"
                 self.gol = self.sub_gol = ""
                 self._finalize_entry(current_entry, buffer_cakupan)
                 current_entry = None; buffer_cakupan = []
                 continue
 
-            if match := PATTERNS["golongan"].match(line):
+            if level == "golongan" and (match := match_golongan(line)):
                 self.gol = f"{match.group(1)} {match.group(2)}"
                 self.sub_gol = ""
                 self._finalize_entry(current_entry, buffer_cakupan)
                 current_entry = None; buffer_cakupan = []
                 continue
 
-            if match := PATTERNS["sub_golongan"].match(line):
+            if level == "sub_golongan" and (match := match_sub_golongan(line)):
                 self.sub_gol = f"{match.group(1)} {match.group(2)}"
                 self._finalize_entry(current_entry, buffer_cakupan)
                 current_entry = None; buffer_cakupan = []
                 continue
 
             # 2. Target Utama: Kelompok (5 Digit)
-            if match := PATTERNS["kelompok"].match(line):
+            if level == "kelompok" and (match := match_kelompok(line)):
                 # Simpan entry sebelumnya dulu sebelum mulai yang baru
                 self._finalize_entry(current_entry, buffer_cakupan)
                 buffer_cakupan = [] 
@@ -141,16 +196,10 @@ class FastKBLIParser:
             if current_entry:
                 # Cek apakah baris ini adalah header/footer (noise)
                 # Contoh noise: angka halaman tunggal, atau header berulang
-                if line.isdigit() and len(line) < 4: continue 
-                
-                # Jika baris ini ternyata match pattern kode lain (misal langsung masuk kode berikutnya tanpa cakupan)
-                if PATTERNS["any_code_start"].match(line):
-                    # Ini shouldn't happen here karena sudah dicek di blok "if match" di atas,
-                    # tapi ini fail-safe kalau patternnya kompleks.
-                    # Dalam logic stream ini, blok "if match" di atas akan menangkap duluan.
-                    # Jadi bagian ini aman: apapun yang lolos ke sini adalah teks biasa.
-                    pass
+                if len(line) < 4 and line.isdigit(): continue
                 
+                # Baris header kode sudah ditangkap blok di atas (continue),
+                # jadi apapun yang lolos ke sini adalah teks biasa
                 buffer_cakupan.append(line)
 
         # Finalize entry terakhir
@@ -165,8 +214,9 @@ class FastKBLIParser:
             # Join buffer text
             full_text = " ".join(buffer)
             # Bersihkan prefix umum
-            full_text = re.sub(r"^(Kelompok|Subgolongan|Golongan) ini mencakup\s*", "", full_text, flags=re.IGNORECASE)
-            entry.cakupan = full_text.strip()
+            full_text = CAKUPAN_PREFIX.sub("", full_text)
+            # Bersihkan spasi berlebih sekali di sini (sekaligus strip)
+            entry.cakupan = " ".join(full_text.split())
             self.entries.append(entry)
 
     def to_json(self, output_path: Path):
@@ -189,8 +239,12 @@ class FastKBLIParser:
             d["content"] = entry.to_content_text()
             data.append(d)
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        if orjson is not None:
+            # Output sama dengan json.dump(indent=2, ensure_ascii=False), tapi di C
+            Path(output_path).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        else:
+            with open(output_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
         print(f"[OK] Saved to {output_path}")
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 import pandas as pd
-import pdfplumber
+import fitz  # PyMuPDF
 import re
 from pathlib import Path
 
@@ -44,9 +44,8 @@ def explore_excel():
             print("\nSearching KBLI patterns (5 digits) in object columns...")
             for col in df.columns:
                 if df[col].dtype == 'object':
-                    # Hindari apply(lambda) jika bisa, tapi untuk eksplorasi awal ini oke
-                    matches = df[col].astype(str).apply(lambda x: kbli_pattern.findall(x))
-                    count = matches.apply(len).sum()
+                    # Satu pass vektor via .str.count (tanpa apply(lambda) per sel)
+                    count = int(df[col].astype(str).str.count(kbli_pattern.pattern).sum())
                     if count > 0:
                         print(f"  - Kolom '{col}': {count} match ditemukan")
 
@@ -60,8 +59,8 @@ def explore_pdf():
         print(f"Error: File tidak ditemukan di {PDF_PATH}")
         return
 
-    with pdfplumber.open(PDF_PATH) as pdf:
-        total_pages = len(pdf.pages)
+    with fitz.open(PDF_PATH) as doc:
+        total_pages = len(doc)
         print(f"Total Halaman: {total_pages}")
         
         # Halaman sampel untuk melihat pola teks
@@ -69,10 +68,10 @@ def explore_pdf():
         for pg_num in sample_pages:
             if pg_num < total_pages:
                 print(f"\n--- Reading Halaman {pg_num + 1} ---")
-                page = pdf.pages[pg_num]
+                page = doc[pg_num]
                 
                 # Fokus ke text extraction karena jauh lebih ringan dari table extraction
-                text = page.extract_text()
+                text = page.get_text("text")
                 if text:
                     print(text[:1000] + "..." if len(text) > 1000 else text)
                 else:
@@ -80,7 +79,7 @@ def explore_pdf():
 
                 # TABLE EXTRACTION (DIMATIKAN UNTUK MENCEGAH HANG)
                 # Jika ingin mencoba, lakukan hanya pada 1 halaman spesifik yang sudah pasti ada tabelnya.
-                # tables = page.extract_tables() 
+                # tables = page.find_tables().tables
                 # print(f"Tables detected: {len(tables)}")
 
 if __name__ == "__main__":
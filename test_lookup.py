@@ -2,27 +2,37 @@
 import json
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # Optional: falls back to stdlib json
+    orjson = None
+
 json_path = Path("kbli_parsed_fast.json")
-with open(json_path, 'r', encoding='utf-8') as f:
-    data = json.load(f)
+if orjson is not None:
+    data = orjson.loads(json_path.read_bytes())
+else:
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+# Validate each entry once: (stripped 5-digit code, entry)
+valid = [
+    (code, e) for e in data
+    if (code := e.get('kode_kbli', '').strip()).isdigit() and len(code) == 5
+]
 
 # Count 5-digit codes
-codes_5digit = [e['kode_kbli'] for e in data if e.get('kode_kbli', '').isdigit() and len(e.get('kode_kbli', '')) == 5]
+codes_5digit = [code for code, _ in valid]
 print(f"Total entries: {len(data)}")
 print(f"5-digit codes: {len(codes_5digit)}")
 print(f"Unique 5-digit codes: {len(set(codes_5digit))}")
 print(f"\nSample codes: {codes_5digit[:20]}")
 print(f"\nSample from end: {codes_5digit[-20:]}")
 
-# Build lookup dict  
-lookup = {}
-for entry in data:
-    code = entry.get("kode_kbli", "").strip()
-    if code and code.isdigit() and len(code) == 5:
-        lookup[code] = {
-            "judul": entry.get("judul", ""),
-            "hierarki": entry.get("hierarki", "")
-        }
+# Build lookup dict
+lookup = {
+    code: {"judul": e.get("judul", ""), "hierarki": e.get("hierarki", "")}
+    for code, e in valid
+}
 
 print(f"\nLookup dictionary size: {len(lookup)}")
 
@@ -1,21 +1,39 @@
 
 import json
 import re
-import pdfplumber
+import fitz  # PyMuPDF
 from pathlib import Path
 from tqdm import tqdm
 
+try:
+    import orjson
+except ImportError:  # Optional: existing JSON loaded with stdlib json
+    orjson = None
+
+# The 88 KBLI 2020 golongan pokok (first two digits of every 5-digit code).
+# A match outside these is page/column noise, not a KBLI code
+VALID_GOLONGAN_POKOK = frozenset(
+    f"{n:02d}" for n in [
+        *range(1, 4), *range(5, 34), *range(35, 40), *range(41, 44),
+        *range(45, 48), *range(49, 54), 55, 56, *range(58, 67), *range(68, 76),
+        *range(77, 83), *range(84, 89), *range(90, 100)
+    ]
+)
+
 def extract_from_pdf(pdf_path):
     print(f"📄 Reading PDF: {pdf_path}")
     extracted_data = {}
     
-    with pdfplumber.open(pdf_path) as pdf:
-        full_text = ""
-        # Read all pages
-        for page in tqdm(pdf.pages, desc="Extracting text"):
-            text = page.extract_text()
+    with fitz.open(pdf_path) as doc:
+        parts = []
+        # Read all pages. Content-stream order (no sort=True): sorted output
+        # keeps the column layout on one line, which the regex below cannot match
+        for page in tqdm(doc, desc="Extracting text", total=len(doc)):
+            text = page.get_text("text")
             if text:
-                full_text += "\n" + text
+                parts.append(text)
+        # One join instead of growing a string per page ("\n" before each page)
+        full_text = "\n" + "\n".join(parts) if parts else ""
     
     # Regex pattern to capture KBLI 2020 structure
     # Patterns: 5 digit code followed by Title
@@ -23,11 +41,17 @@ def extract_from_pdf(pdf_path):
     pattern = re.compile(r'\n(\d{5})\s+([A-Z\s\/\.,\-\(\)]+?)(?=\n\d{5}|\n[A-Z]|\nUraian|\Z)', re.DOTALL)
     
     matches = pattern.finditer(full_text)
+    skipped = 0
     
     for match in matches:
         code = match.group(1).strip()
         title = match.group(2).strip().replace('\n', ' ')
         
+        # Sanity check: reject codes outside KBLI's golongan pokok and empty titles
+        if code[:2] not in VALID_GOLONGAN_POKOK or not title:
+            skipped += 1
+            continue
+        
         # Simple heuristic to extract description/cakupan if available nearby
         # (This is basic, might need refinement for detailed cakupan extraction)
         
@@ -39,6 +63,8 @@ def extract_from_pdf(pdf_path):
             "metadata": {"source": "pdf_update"}
         }
         
+    if skipped:
+        print(f"⚠️ Skipped {skipped} matches that are not valid KBLI codes.")
     print(f"✅ Extracted {len(extracted_data)} potential KBLI codes from PDF.")
     return extracted_data
 
@@ -46,8 +72,11 @@ def update_json_file(json_path, new_data):
     print(f"📂 Loading existing JSON: {json_path}")
     
     try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            existing_list = json.load(f)
+        if orjson is not None:
+            existing_list = orjson.loads(Path(json_path).read_bytes())
+        else:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                existing_list = json.load(f)
     except FileNotFoundError:
         existing_list = []
         